@@ -0,0 +1,266 @@
+#!/usr/bin/python
+# encoding: utf-8
+##############################################################################
+#
+# benchmark.py
+#
+# Benchmarks for gogorender.py.
+#
+# Synthetic decks are rendered through Gogorender.run (or run_batch) with a
+# stub component manager, first into an empty media directory (cold) and
+# then again with a fresh filter (warm) and with the same filter (memo).
+# Run with --help for the options.
+#
+# Qt 4 renders text through the window system, so on X11 a display is
+# needed. Without one (DISPLAY unset), the benchmark runs itself under
+# xvfb-run, i.e., on a virtual framebuffer.
+#
+# Requires PyQt4 and Mnemosyne (for the plugin's imports), and Xvfb on
+# machines without a display.
+#
+##############################################################################
+
+from __future__ import print_function
+
+import os, sys
+
+if (sys.platform not in ('win32', 'darwin') and not os.environ.get('DISPLAY')
+        and not os.environ.get('GOGORENDER_XVFB')):
+    os.environ['GOGORENDER_XVFB'] = '1'
+    try:
+        os.execvp('xvfb-run', ['xvfb-run', '-a', sys.executable] + sys.argv)
+    except OSError:
+        sys.exit("benchmark.py: no display, and xvfb-run was not found")
+
+import argparse
+import random
+import resource
+import shutil
+import tempfile
+import time
+
+from PyQt4 import QtGui
+
+app = QtGui.QApplication(sys.argv)
+
+import gogorender
+
+# - - - stubs - - -
+
+class Config(dict):
+
+    def card_type_property(self, property_name, card_type, fact_key=None,
+                           default=None):
+        try:
+            return self[property_name][card_type.id][fact_key]
+        except KeyError:
+            return default
+
+class Database(object):
+
+    def __init__(self, media_dir):
+        self.path = media_dir
+
+    def media_dir(self):
+        return self.path
+
+class ComponentManager(object):
+    debug_file = None
+
+    def __init__(self, config, database):
+        self.components = { "config" : config, "database" : database }
+
+    def current(self, comp_type, used_for=None):
+        return self.components[comp_type]
+
+    def all(self, comp_type, used_for=None):
+        return []
+
+    def debug(self, msg):
+        pass
+
+class CardType(object):
+
+    def __init__(self, id, fact_keys):
+        self.id = id
+        self.fact_keys = fact_keys
+
+    def fact_key_format_proxies(self):
+        return {k : k for k in self.fact_keys}
+
+class Tag(object):
+
+    def __init__(self, name):
+        self.name = name
+
+class Card(object):
+
+    def __init__(self, id, card_type, tags):
+        self.id = id
+        self.card_type = card_type
+        self.tags = tags
+
+# - - - synthetic decks - - -
+
+def chars(first, last):
+    return [unichr(c) for c in range(first, last + 1)]
+
+cjk_chars = chars(0x4e00, 0x4fff)
+kana_chars = chars(0x3041, 0x3093)
+greek_chars = chars(0x03b1, 0x03c9)
+ipa_chars = chars(0x0250, 0x02af)
+arabic_chars = chars(0x0627, 0x064a)
+hebrew_chars = chars(0x05d0, 0x05ea)
+latin_words = [u'the', u'word', u'means', u'a', u'of', u'to', u'in', u'see',
+               u'also', u'plural', u'noun', u'verb', u'example']
+
+def make_word(rnd, alphabet, shortest, longest):
+    return u''.join(rnd.choice(alphabet)
+                    for i in range(rnd.randint(shortest, longest)))
+
+def latin(rnd, n):
+    return u' '.join(rnd.choice(latin_words) for i in range(n))
+
+# Vocabulary cards: a few thousand characters reused over many words.
+def cjk_deck(rnd, ncards):
+    vocabulary = [make_word(rnd, cjk_chars[:3000], 1, 3)
+                  for i in range(max(10, ncards // 2))]
+    for i in range(ncards):
+        word = rnd.choice(vocabulary)
+        reading = make_word(rnd, kana_chars, 2, 6)
+        example = u'%s%s%s。' % (rnd.choice(vocabulary), reading,
+                                rnd.choice(vocabulary))
+        yield ([u'<b>%s</b>' % word,
+                u'%s<br>%s (%s)' % (reading, latin(rnd, 3), example)], [])
+
+# Latin text with Greek words and IPA transcriptions.
+def greek_deck(rnd, ncards):
+    for i in range(ncards):
+        greek = make_word(rnd, greek_chars, 3, 9)
+        ipa = make_word(rnd, ipa_chars, 3, 8)
+        yield ([u'%s %s' % (greek, latin(rnd, 2)),
+                u'/%s/ %s <i>%s</i>' % (ipa, latin(rnd, 6), greek)], [])
+
+# Long right-to-left lines, rendered as whole lines (render_line_tags).
+def rtl_deck(rnd, ncards):
+    for i in range(ncards):
+        alphabet = arabic_chars if i % 2 else hebrew_chars
+        lines = [u' '.join(make_word(rnd, alphabet, 2, 7)
+                           for j in range(rnd.randint(4, 12)))
+                 for k in range(rnd.randint(1, 3))]
+        yield ([u'<br>'.join(lines), latin(rnd, 4)], [Tag(u'rtl')])
+
+decks = {
+    'cjk'   : cjk_deck,
+    'greek' : greek_deck,
+    'rtl'   : rtl_deck,
+}
+
+def make_fields(deck, ncards, seed):
+    rnd = random.Random(seed)
+    card_type = CardType(u'1', ['f', 'b'])
+    fields = []
+    for (i, (texts, tags)) in enumerate(decks[deck](rnd, ncards)):
+        card = Card(i, card_type, tags)
+        for (fact_key, text) in zip(card_type.fact_keys, texts):
+            fields.append((text, card, fact_key))
+    return fields
+
+# - - - benchmark - - -
+
+def make_filter(media_dir, options):
+    config = Config({
+        "gogorender" : {
+            "render_line_tags" : u'rtl',
+            "render_threads"   : options.threads,
+            "render_processes" : options.processes,
+            "png_mode"         : options.png_mode,
+            "tile_blocks"      : options.tile_blocks,
+            "autocrop"         : options.autocrop,
+            "dedupe"           : options.dedupe,
+            "extra_scales"     : options.extra_scales,
+        },
+        "non_latin_font_size_increase" : 0,
+        "font" : { u'1' : { 'f' : options.font, 'b' : options.font } },
+    })
+    cm = ComponentManager(config, Database(media_dir))
+    return gogorender.Gogorender(cm)
+
+def peak_rss():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss  # kilobytes
+
+def measure(name, filter, fields, ncards, options):
+    filter.reset_counters()
+    start = time.time()
+    if options.window:
+        for text in filter.run_stream(fields, window=options.window):
+            pass
+    elif options.batch:
+        filter.run_batch(fields)
+    else:
+        for (text, card, fact_key) in fields:
+            filter.run(text, card, fact_key)
+    elapsed = max(time.time() - start, 1e-9)
+
+    c = filter.counters
+    words = c['cache_hits'] + c['cache_misses']
+    print("  %-5s %8.1f cards/s %9.1f words/s  hits %5.1f%%  memo %5d"
+          "  %6d images %9d bytes  peak rss %d KiB"
+          % (name, ncards / elapsed, words / elapsed,
+             100.0 * c['cache_hits'] / max(words, 1), c['fields_memo'],
+             c['images'], c['bytes_written'], peak_rss()))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark gogorender.")
+    parser.add_argument('--deck', choices=sorted(decks) + ['all'],
+                        default='all')
+    parser.add_argument('--cards', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--batch', action='store_true',
+                        help="use run_batch instead of run")
+    parser.add_argument('--window', type=int, default=0,
+                        help="use run_stream with this window instead of run")
+    parser.add_argument('--threads', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=0)
+    parser.add_argument('--png-mode', default='argb')
+    parser.add_argument('--tile-blocks', default=u'',
+                        help="compose words of these blocks from glyph tiles,"
+                             " e.g., '3040-30ff 4e00-9fff'")
+    parser.add_argument('--autocrop', action='store_true',
+                        help="trim empty columns from images (needs numpy)")
+    parser.add_argument('--dedupe', action='store_true',
+                        help="share files between identical images")
+    parser.add_argument('--extra-scales', default=u'',
+                        help="also render at these scales, e.g., '1.5 2'")
+    parser.add_argument('--font', default=u'DejaVu Sans,16,-1,5,50,0,0,0,0,0')
+    parser.add_argument('--estimate', action='store_true',
+                        help="print the estimate for the cold run first")
+    parser.add_argument('--keep', action='store_true',
+                        help="keep the media directory")
+    options = parser.parse_args()
+
+    for deck in (sorted(decks) if options.deck == 'all' else [options.deck]):
+        fields = make_fields(deck, options.cards, options.seed)
+        media_dir = tempfile.mkdtemp(prefix='gogorender-')
+        print("%s: %d cards, %d fields (%s)"
+              % (deck, options.cards, len(fields), media_dir))
+        try:
+            filter = make_filter(media_dir, options)
+            if options.estimate:
+                e = filter.estimate(fields)
+                print("  estimate: %d images, %d pixels, %d bytes, %.1f s"
+                      % (e['images'] - e['cached'], e['new_pixels'],
+                         e['bytes'], e['seconds']))
+            measure("cold", filter, fields, options.cards, options)
+            measure("memo", filter, fields, options.cards, options)
+            filter = make_filter(media_dir, options)
+            measure("warm", filter, fields, options.cards, options)
+        finally:
+            if not options.keep:
+                shutil.rmtree(media_dir)
+
+if __name__ == '__main__':
+    main()
@@ -32,12 +32,43 @@ from copy import copy
 import os, os.path
 import shutil
 import math
+import time
+import errno
+import threading
+from collections import OrderedDict, deque
+from itertools import islice
+import multiprocessing
+import subprocess
+import tempfile
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from thread import get_ident as thread_id
+except ImportError:
+    from threading import get_ident as thread_id
 
 try:
     from hashlib import md5
 except ImportError:
     from md5 import md5
 
+import json
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from html import unescape as unescape_html
+except ImportError:
+    from HTMLParser import HTMLParser
+    unescape_html = HTMLParser().unescape
+
 def tr(msg):
     return QtCore.QCoreApplication.translate("Mnemogogo", msg)
 
@@ -59,6 +90,27 @@ default_config = {
     'render_line_tags' : u'',
     'max_line_width'   : 240,
     'font_scaling'     : 1.0,
+    'render_threads'   : 0,         # 0 = one per processor (run_batch)
+    'render_processes' : 0,         # 0 = render in this process only
+    'png_mode'         : 'argb',    # or 'indexed' or 'mono', see save_image
+    'png_compression'  : -1,        # zlib level 0-9, -1 = Qt's default
+    'png_optimiser'    : u'',       # e.g., u'optipng -quiet -o2 %s'
+    'collect_stats'    : False,     # time the stages of rendering
+    'cache_layout'     : 'flat',    # or 'sharded', see RenderCache
+    'cache_max_bytes'  : 0,         # evict after exports, 0 = no limit
+    'memo_size'        : 10000,     # fields remembered by run(), 0 = none
+    'memo_persist'     : False,     # keep remembered fields between sessions
+    'tile_blocks'      : u'',       # e.g., u'3040-30ff 4e00-9fff', see glyph_tile
+    'tile_cache_size'  : 4096,      # glyph tiles kept in memory
+    'prerender'        : False,     # render added and edited cards when idle
+    'prerender_queue_size' : 1000,  # cards waiting to be prerendered
+    'stream_window'    : 200,       # fields rendered at once by run_stream
+    'estimate_sample'  : 20,        # images painted by estimate to calibrate
+    'autocrop'         : False,     # trim empty columns (needs numpy)
+    'dedupe'           : False,     # share files between identical images
+    'coalesce_words'   : False,     # one image for nearby words, see coalesce
+    'coalesce_width'   : 0,         # widest coalesced image, 0 = max_line_width
+    'extra_scales'     : u'',       # e.g., u'1.5, 2', see Gogorender.run
 
     'default_render'  : False,
 }
@@ -122,6 +174,16 @@ class GogorenderConfigWdgt(QtGui.QWidget, ConfigurationWidget):
         self.transparent.setChecked(self.setting("transparent"))
         toplayout.addRow(tr("Render with transparency:"), self.transparent)
 
+        self.coalesce_words = QtGui.QCheckBox(self)
+        self.coalesce_words.setChecked(self.setting("coalesce_words"))
+        toplayout.addRow(tr("Render words on a line as one image:"),
+                         self.coalesce_words)
+
+        self.prerender = QtGui.QCheckBox(self)
+        self.prerender.setChecked(self.setting("prerender"))
+        toplayout.addRow(tr("Render new and edited cards in the background:"),
+                         self.prerender)
+
         self.default_render = QtGui.QCheckBox(self)
         self.default_render.setChecked(self.setting("default_render"))
         toplayout.addRow(tr("Render in Mnemosyne (for testing):"),
@@ -131,6 +193,7 @@ class GogorenderConfigWdgt(QtGui.QWidget, ConfigurationWidget):
 
     def apply(self):
         was_default_render = self.setting('default_render')
+        was_prerender = self.setting('prerender')
 
         config = self.config()['gogorender']
 
@@ -138,11 +201,15 @@ class GogorenderConfigWdgt(QtGui.QWidget, ConfigurationWidget):
         config["render_line_tags"] = u"%s" % unicode(self.render_line_tags.text())
         config["transparent"]      = self.transparent.isChecked()
         config["default_render"]   = self.default_render.isChecked()
+        config["prerender"]        = self.prerender.isChecked()
+        config["coalesce_words"]   = self.coalesce_words.isChecked()
         config["max_line_width"]   = self.max_line_width.value()
         config["font_scaling"]     = float(self.font_scaling.value()) / 100.0
 
+        # Images are kept per generation of the settings that affect their
+        # pixels (see generation_name), stale generations are removed by
+        # the filter once it renders into a new one.
         imgpath = self.setting("imgpath")
-        if os.path.exists(imgpath): shutil.rmtree(imgpath)
         if not os.path.exists(imgpath): os.mkdir(imgpath)
 
         for chain in render_chains:
@@ -152,6 +219,11 @@ class GogorenderConfigWdgt(QtGui.QWidget, ConfigurationWidget):
                     filter.reconfigure()
             except KeyError: pass
 
+        if was_prerender != config['prerender']:
+            for hook in self.component_manager.all("hook", "after_load"):
+                if isinstance(hook, GogorenderPrerender):
+                    hook.run()
+
         if was_default_render != config['default_render']:
             if was_default_render:
                 self.render_chain('default').unregister_filter(Gogorender)
@@ -159,57 +231,1640 @@ class GogorenderConfigWdgt(QtGui.QWidget, ConfigurationWidget):
                 self.render_chain('default').register_filter_at_back(
                         Gogorender, before=["ExpandPaths"])
 
-def moveprev(pos):
-    pos.movePosition(QTextCursor.PreviousCharacter, QTextCursor.KeepAnchor)
+# The last export number, in the render directory (see begin_export).
+export_counter = "export.txt"
+
+class RenderCache(object):
+    """Index of the images in a render directory.
+
+    The names of rendered images are kept in memory and in a manifest file
+    in the same directory, so that a cache hit never touches the filesystem.
+    The manifest also records the modification times of the directories as
+    they were when last listed; a directory modified since (e.g., files
+    deleted by hand, or images written by another exporter) is listed again
+    and the index brought up to date.
+
+    Images are either stored directly in the directory ('flat' layout) or
+    in two levels of subdirectories named after the first two hexadecimal
+    digits of their names ('sharded' layout). The layout is recorded in the
+    manifest; when it changes, the images are moved to their new places.
+
+    For each image, the index also keeps its size and the last export that
+    referenced it, which are used to limit the size of the cache and to
+    delete images that are no longer used (see evict and sweep). Exports
+    are numbered by begin_export.
+
+    When the digests of their pixels are given, identical images are kept
+    in a single file: the names of the others become aliases of it, and
+    resolve() gives the name of the file for any name in the cache.
+
+    The images that each export referred to can be recorded, with those
+    written during the export marked, for finding the files that changed
+    between two exports (see record_export and changes_since).
+    """
+
+    manifest = "index.txt"
+    check_interval = 5.0    # seconds between checks for outside changes
+    mtime_resolution = 2.0  # seconds, coarsest directory mtime granularity
+    leftover_age = 3600.0   # seconds before temporary files are removed
+    layouts = ('flat', 'sharded')
+    shard_digits = "0123456789abcdef"
+    exports_kept = 10       # recorded exports kept, see record_export
+    export_re = re.compile(r'^export-(\d+)\.txt$')
+
+    def __init__(self, path, layout='flat'):
+        self.path = path
+        self.layout = layout
+        self.manifest_path = os.path.join(path, self.manifest)
+        self.entries = {}       # name -> [size, last export, digest]
+        self.aliases = {}       # name -> name of an identical image
+        self.digests = {}       # digest -> name
+        self.added = set()      # names added since begin_export
+        self.mtimes = {}        # directory -> mtime when last listed
+        self.export = 0
+        self.previous_export = 0    # the export before begin_export
+        self.checked = 0.0
+        self.refresh(force=True)
+
+    def __contains__(self, name):
+        return name in self.entries or name in self.aliases
+
+    def __len__(self):
+        return len(self.entries)
+
+    def total_size(self):
+        return sum(entry[0] for entry in self.entries.values())
+
+    def has_file(self, name):
+        return name in self.entries
+
+    # The name of the file that holds an image.
+    def resolve(self, name):
+        return self.aliases.get(name, name)
+
+    # The path of an image relative to the directory, with '/' separators.
+    def subpath(self, name):
+        if self.layout == 'sharded':
+            return name[0] + "/" + name[1] + "/" + name
+        else:
+            return name
+
+    def filepath(self, name):
+        return os.path.join(self.path, *self.subpath(name).split("/"))
+
+    def directories(self):
+        yield self.path
+        if self.layout == 'sharded':
+            for a in self.shard_digits:
+                yield os.path.join(self.path, a)
+                for b in self.shard_digits:
+                    yield os.path.join(self.path, a, b)
+
+    def _mtime(self, path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    # Returns {directory : mtime}, to be taken before listing directories.
+    # Times too close to now are recorded as None (i.e., to be listed again
+    # at the next check), as a change in the same tick would go unseen.
+    def dir_mtimes(self):
+        now = time.time()
+        mtimes = {}
+        for d in self.directories():
+            mtime = self._mtime(d)
+            if mtime is not None and now - mtime < self.mtime_resolution:
+                mtime = None
+            mtimes[d] = mtime
+        return mtimes
+
+    def refresh(self, force=False):
+        now = time.time()
+        if not force and now - self.checked < self.check_interval:
+            return
+        self.checked = now
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+            self.rescan()
+            return
+
+        if force:
+            if not os.path.exists(self.manifest_path):
+                self.rescan()
+                return
+            self.load()
+
+        changed = [d for d in self.directories()
+                   if self.mtimes.get(d) is None
+                      or self._mtime(d) != self.mtimes[d]]
+        if changed:
+            self.update(changed)
+
+    # The manifest starts with '#layout <layout>', '#export <number>' and
+    # '#mtimes <mtime>...' (one per directory, in the order of directories(),
+    # '-' if unknown), followed by lines '<name> <size> <last export>
+    # <digest>', where the digest is '-' if unknown, and lines '= <alias>
+    # <name>'. Later lines for the same name replace earlier ones.
+    def load(self):
+        with open(self.manifest_path, "r") as f:
+            lines = [line.split() for line in f]
+        try:
+            header = {fields[0] : fields[1:] for fields in lines[:3]
+                      if fields[0].startswith("#")}
+            self.export = int(header["#export"][0])
+            self.entries = {}
+            self.aliases = {}
+            for fields in lines[len(header):]:
+                if fields[0] == "=":
+                    (eq, alias, name) = fields
+                    self.aliases[alias] = name
+                else:
+                    (name, size, export, digest) = fields
+                    self.entries[name] = [int(size), int(export), digest]
+        except (IndexError, KeyError, ValueError):
+            self.entries = {}
+            self.aliases = {}
+            self.rescan()
+            return
+
+        self.index_digests()
+        if header.get("#layout") != [self.layout]:
+            self.rescan()
+            return
+
+        directories = list(self.directories())
+        mtimes = header.get("#mtimes", [])
+        if len(mtimes) != len(directories):
+            mtimes = ["-"] * len(directories)
+        self.mtimes = {d : None if mtime == "-" else float(mtime)
+                       for (d, mtime) in zip(directories, mtimes)}
+
+    def index_digests(self):
+        self.digests = {entry[2] : name
+                        for (name, entry) in self.entries.items()
+                        if entry[2] != "-"}
+
+    # Rebuild the index from the files in the directory, moving images
+    # that are not where the layout puts them.
+    def rescan(self):
+        old = self.entries
+        self.entries = {}
+        for d in self.directories():
+            if not os.path.isdir(d):
+                os.mkdir(d)
+        self.mtimes = self.dir_mtimes()
+
+        for (root, dirs, files) in os.walk(self.path):
+            for name in files:
+                path = os.path.join(root, name)
+                if name.endswith(".png"):
+                    if path != self.filepath(name):
+                        os.rename(path, self.filepath(name))
+                    (size, export, digest) = old.get(name,
+                                                     (None, self.export, "-"))
+                    if size is None:
+                        size = os.path.getsize(self.filepath(name))
+                    self.entries[name] = [size, export, digest]
+                elif ".png.tmp-" in name:
+                    self.remove_leftover(path)
+
+        if self.layout == 'flat':
+            for a in self.shard_digits:
+                for b in self.shard_digits:
+                    self.remove_empty_dir(os.path.join(self.path, a, b))
+                self.remove_empty_dir(os.path.join(self.path, a))
+
+        self.aliases = {alias : name for (alias, name) in self.aliases.items()
+                        if name in self.entries and alias not in self.entries}
+        self.index_digests()
+        self.save()
+
+    # Bring the index up to date with the images in some directories,
+    # whose modification times changed since they were last listed.
+    # Falls back to a rescan if an image is not where the layout puts it.
+    def update(self, changed):
+        mtimes = self.dir_mtimes()
+        found = set()
+        for d in changed:
+            try:
+                names = os.listdir(d)
+            except OSError:
+                self.rescan()
+                return
+            for name in names:
+                if name.endswith(".png"):
+                    if os.path.join(d, name) != self.filepath(name):
+                        self.rescan()
+                        return
+                    found.add(name)
+
+        changed = set(changed)
+        if self.layout == 'flat':
+            listed = list(self.entries)
+        else:
+            listed = [name for name in self.entries
+                      if os.path.dirname(self.filepath(name)) in changed]
+        deleted = [name for name in listed if name not in found]
+        for name in deleted:
+            self.forget(name)
+        new = [name for name in found if name not in self.entries]
+        for name in new:
+            self.aliases.pop(name, None)
+            self.entries[name] = [os.path.getsize(self.filepath(name)),
+                                  self.export, "-"]
+
+        for d in changed:
+            self.mtimes[d] = mtimes[d]
+        if deleted or new:
+            self.save()
+
+    # Remove a temporary file left behind by a crashed exporter.
+    def remove_leftover(self, path):
+        try:
+            if time.time() - os.stat(path).st_mtime > self.leftover_age:
+                os.remove(path)
+        except OSError:
+            pass
+
+    def remove_empty_dir(self, path):
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass
+
+    def save(self):
+        mtimes = [self.mtimes.get(d) for d in self.directories()]
+        with open(self.manifest_path, "w") as f:
+            f.write("#layout %s\n#export %d\n#mtimes %s\n"
+                    % (self.layout, self.export,
+                       " ".join("-" if m is None else repr(m)
+                                for m in mtimes)))
+            for (name, (size, export, digest)) in self.entries.items():
+                f.write("%s %d %d %s\n" % (name, size, export, digest))
+            for (alias, name) in self.aliases.items():
+                f.write("= %s %s\n" % (alias, name))
+
+    # Add a new image, with the digest of its pixels if known. If another
+    # image has the same digest, the new file is deleted and its name made
+    # an alias of the other. Returns the name of the file that holds it.
+    def add(self, name, size, digest="-"):
+        other = self.digests.get(digest)
+        if other is not None and other != name:
+            remove_file(self.filepath(name))
+            self.aliases[name] = other
+            self.touch(other)
+            with open(self.manifest_path, "a") as f:
+                f.write("= %s %s\n" % (name, other))
+            return other
+
+        self.entries[name] = [size, self.export, digest]
+        self.added.add(name)
+        if digest != "-":
+            self.digests[digest] = name
+        with open(self.manifest_path, "a") as f:
+            f.write("%s %d %d %s\n" % (name, size, self.export, digest))
+        return name
+
+    # Record that the current export refers to an image. This is only kept
+    # in memory until the manifest is next saved.
+    def touch(self, name):
+        try:
+            self.entries[self.resolve(name)][1] = self.export
+        except KeyError:
+            pass
+
+    # Start an export, numbered export if given and otherwise the one after
+    # the last.
+    def begin_export(self, export=None):
+        self.previous_export = self.export
+        self.export = self.export + 1 if export is None else export
+        self.added = set()
+        self.save()
+        return self.export
+
+    # Whether the current export referred to any image.
+    def referenced(self):
+        return any(entry[1] == self.export for entry in self.entries.values())
+
+    # Undo begin_export for an export that referred to nothing, so that the
+    # last recorded export stays the current one.
+    def cancel_export(self):
+        self.export = self.previous_export
+        self.added = set()
+        self.save()
+
+    def export_path(self, export):
+        return os.path.join(self.path, "export-%d.txt" % export)
+
+    # Exports are recorded in files 'export-<number>.txt', with a line
+    # '<subpath> <size> <md5 of the file> <new>' for each image that the
+    # current export referred to, where new is 1 for the images written
+    # since begin_export. The oldest records are deleted.
+    def record_export(self):
+        recorded = [n for n in self.recorded_exports() if n < self.export]
+        previous = recorded and self.read_export(recorded[-1]) or {}
+        sums = {subpath.rsplit("/", 1)[-1] : md5sum
+                for (subpath, (size, md5sum, new)) in previous.items()}
+
+        path = self.export_path(self.export)
+        tmppath = path + ".tmp"
+        with open(tmppath, "w") as f:
+            for (name, (size, export, digest)) in self.entries.items():
+                if export != self.export:
+                    continue
+                new = name in self.added
+                md5sum = None if new else sums.get(name)
+                if md5sum is None:
+                    md5sum = file_md5(self.filepath(name))
+                if md5sum is not None:
+                    f.write("%s %d %s %d\n"
+                            % (self.subpath(name), size, md5sum, new))
+        remove_file(path)
+        os.rename(tmppath, path)
+
+        for n in recorded[:max(len(recorded) + 1 - self.exports_kept, 0)]:
+            remove_file(self.export_path(n))
+
+    # The numbers of the recorded exports, in increasing order.
+    def recorded_exports(self):
+        numbers = []
+        for name in os.listdir(self.path):
+            m = self.export_re.match(name)
+            if m:
+                numbers.append(int(m.group(1)))
+        return sorted(numbers)
+
+    # Returns {subpath : (size, md5, new)} for a recorded export, or None.
+    def read_export(self, export):
+        try:
+            with open(self.export_path(export), "r") as f:
+                lines = [line.split() for line in f]
+            return {subpath : (int(size), md5sum, new == "1")
+                    for (subpath, size, md5sum, new) in lines}
+        except (IOError, OSError, ValueError):
+            return None
+
+    # Returns (added, removed) from a recorded export to the current one,
+    # where added lists (subpath, size, md5) for the images that are new
+    # or changed, and removed the subpaths of those no longer referred
+    # to, or None if either export was not recorded.
+    def changes_since(self, since):
+        old = self.read_export(since)
+        new = self.read_export(self.export)
+        if old is None or new is None:
+            return None
+
+        added = [(subpath, size, md5sum)
+                 for (subpath, (size, md5sum, n)) in sorted(new.items())
+                 if subpath not in old or old[subpath][1] != md5sum]
+        removed = sorted(subpath for subpath in old if subpath not in new)
+        return (added, removed)
+
+    # Drop an image, and its aliases, from the index.
+    def forget(self, name):
+        digest = self.entries.pop(name)[2]
+        if self.digests.get(digest) == name:
+            del self.digests[digest]
+        for alias in [a for (a, n) in self.aliases.items() if n == name]:
+            del self.aliases[alias]
+
+    def remove(self, name):
+        self.forget(name)
+        try:
+            os.remove(self.filepath(name))
+        except OSError:
+            pass
+
+    # Delete the least recently exported images until the cache takes at
+    # most max_bytes, but never those of the current export. Returns the
+    # number of images deleted.
+    def evict(self, max_bytes):
+        total = self.total_size()
+        if total <= max_bytes:
+            return 0
+
+        removed = 0
+        by_age = sorted(self.entries.items(), key=lambda e: e[1][1])
+        for (name, (size, export, digest)) in by_age:
+            if total <= max_bytes or export == self.export:
+                break
+            self.remove(name)
+            total -= size
+            removed += 1
+
+        self.save()
+        return removed
+
+    # Delete the images that the current export did not refer to. Returns
+    # the number of images deleted.
+    def sweep(self):
+        unused = [name for (name, entry) in self.entries.items()
+                  if entry[1] != self.export]
+        for name in unused:
+            self.remove(name)
+
+        self.save()
+        return len(unused)
+
+class RenderMemo(object):
+    """Least-recently-used memo of the results of Gogorender.run().
+
+    Each entry maps a key to the rendered text and the names of the images
+    it refers to; an entry is only used while all of these images are files
+    in the render cache. The memo can be saved to and loaded from a file (as
+    JSON, since it is in the media directory and must never run code), in
+    which case it is tagged with a fingerprint of the settings that it
+    depends on."""
+
+    def __init__(self, size, path=None):
+        self.size = size
+        self.path = path
+        self.entries = OrderedDict()
+
+    # Returns (text, names) or None.
+    def get(self, key, cache):
+        try:
+            (text, names) = self.entries.pop(key)
+        except KeyError:
+            return None
+        if [n for n in names if not cache.has_file(n)]:
+            return None
+        self.entries[key] = (text, names)
+        return (text, names)
+
+    def put(self, key, text, names):
+        if self.size <= 0:
+            return
+        self.entries.pop(key, None)
+        self.entries[key] = (text, tuple(names))
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    # The file holds [fingerprint, [[key, [text, names]], ...]], where
+    # tuples become lists.
+    def load(self, fingerprint):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                (saved, entries) = json.load(f)
+            if saved != json.loads(json.dumps(fingerprint)):
+                return
+            if self.size > 0:
+                for (key, (text, names)) in entries[-self.size:]:
+                    self.entries[tuple(key)] = (text, tuple(names))
+        except (IOError, OSError, ValueError, TypeError):
+            self.entries = OrderedDict()
+
+    def save(self, fingerprint):
+        if self.path is None:
+            return
+        tmppath = self.path + ".tmp"
+        with open(tmppath, "w") as f:
+            json.dump([fingerprint, list(self.entries.items())], f)
+        remove_file(self.path)
+        os.rename(tmppath, self.path)
+
+# QImage.save() takes a "quality" that Qt's PNG writer maps linearly onto
+# the zlib levels 9 to 0.
+def png_quality(compression):
+    if compression < 0:
+        return -1
+    return 100 - int(math.ceil(min(compression, 9) * 91 / 9.0))
+
+# Images are stored in a subdirectory named after the settings that change
+# their pixels (but not which words are rendered); changing any of these
+# settings thus starts a new generation of images.
+def generation_name(transparent, font_scaling, max_line_width,
+                    non_latin_font_size_increase, png_mode, autocrop=False):
+    key = "%d-%r-%d-%r" % (bool(transparent), float(font_scaling),
+                           int(max_line_width),
+                           non_latin_font_size_increase)
+    if png_mode != 'argb':
+        key += "-" + png_mode
+    if autocrop:
+        key += "-autocrop"
+    return md5(key.encode("utf-8")).hexdigest()[:8]
+
+# Character classes (bit flags) used when segmenting text into words.
+RENDER     = 1      # matches render_char
+NOT_RENDER = 2      # matches not_render_char
+NOT_WORD   = 4      # matches not_word
+NOT_LINE   = 8      # matches not_line
+UNCLASSIFIED = 0x80 # in a class table: look up with classify()
+
+# Returns the character class of c for a sequence of (QRegExp, flag) pairs
+# giving the patterns of each class.
+def classify(c, regexps):
+    cls = 0
+    for (rx, flag) in regexps:
+        # QTextDocument.find() treats non-breaking spaces as spaces
+        if flag == RENDER and c == u'\xa0':
+            c_ = u' '
+        else:
+            c_ = c
+        if rx.exactMatch(c_):
+            cls |= flag
+    return cls
+
+# Patterns that consist of a single bracket expression, which matches one
+# character whatever the characters around it.
+bracket_re = re.compile(r'^\[(?:\\.|[^\]\\])+\]$', re.DOTALL)
+
+# All characters of the BMP, with NUL in place of the surrogates (which are
+# not valid on their own) so that index and code point coincide.
+bmp_text = None
+
+# Returns the code points below 0x10000 matched by a QRegExp as a
+# bytearray of 0 and 1, where the surrogates and NUL are left at 0.
+def match_bmp(rx):
+    global bmp_text
+    matched = bytearray(0x10000)
+
+    if bracket_re.match(unicode(rx.pattern())):
+        if bmp_text is None:
+            bmp_text = u''.join(u'\0' if 0xd800 <= o < 0xe000 else unichr(o)
+                                for o in range(0x10000))
+        # replace every match with NUL, in one call into Qt
+        text = QtCore.QString(bmp_text)
+        text.replace(rx, QtCore.QString(u'\0'))
+        result = unicode(text)
+        if len(result) == len(bmp_text):
+            for (o, c) in enumerate(result):
+                if c == u'\0' and bmp_text[o] != u'\0':
+                    matched[o] = 1
+            return matched
+
+    for o in range(1, 0x10000):
+        if not 0xd800 <= o < 0xe000 and rx.exactMatch(unichr(o)):
+            matched[o] = 1
+    return matched
+
+# Returns a table of the character classes of the code points below
+# 0x10000 for a sequence of (QRegExp, flag) pairs, as a bytearray.
+# Surrogates and NUL are UNCLASSIFIED.
+def class_table(regexps):
+    table = bytearray(0x10000)
+    for (rx, flag) in regexps:
+        for (o, m) in enumerate(match_bmp(rx)):
+            if m:
+                table[o] |= flag
+
+    table[0xa0] = ((table[0xa0] & ~RENDER)
+                   | classify(u'\xa0', regexps) & RENDER)
+    table[0] = UNCLASSIFIED
+    for o in range(0xd800, 0xe000):
+        table[o] = UNCLASSIFIED
+    return table
+
+# Returns a compiled Python character class of the code points whose class
+# in a class table has the bits of want and none of those of avoid, and of
+# the characters that the table does not classify (UNCLASSIFIED, and those
+# beyond the BMP, which narrow builds hold as surrogate pairs).
+def table_re(table, want, avoid):
+    ranges = []
+    first = None
+    for o in range(0x10001):
+        if o < 0x10000:
+            cls = table[o]
+            member = (cls == UNCLASSIFIED
+                      or ((cls & want) == want and not cls & avoid))
+        else:
+            member = False
+        if member and first is None:
+            first = o
+        elif not member and first is not None:
+            ranges.append(u'%s-%s' % (re.escape(unichr(first)),
+                                      re.escape(unichr(o - 1))))
+            first = None
+    if sys.maxunicode > 0xffff:
+        ranges.append(u'%s-%s' % (unichr(0x10000), unichr(sys.maxunicode)))
+    return re.compile(u'[%s]' % u''.join(ranges), re.UNICODE)
+
+# Wall-clock timer for RenderStats.
+clock = getattr(time, 'perf_counter', time.time)
+
+class RenderStats(object):
+    """Accumulated time and number of calls for each stage of rendering.
+
+    Stages are timed with:
+        t = clock()
+        ...
+        t = stats.add('stage', t)
+    where add() returns the current time for timing the next stage. It may
+    be called from several threads."""
+
+    stages = ('parse', 'segment', 'font', 'measure', 'paint', 'save',
+              'substitute')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.time = dict.fromkeys(self.stages, 0.0)
+        self.calls = dict.fromkeys(self.stages, 0)
+
+    def add(self, stage, since):
+        now = clock()
+        with self.lock:
+            self.time[stage] += now - since
+            self.calls[stage] += 1
+        return now
+
+    def totals(self):
+        return {stage : (self.time[stage], self.calls[stage])
+                for stage in self.stages}
+
+    def merge(self, totals):
+        with self.lock:
+            for (stage, (seconds, calls)) in totals.items():
+                self.time[stage] += seconds
+                self.calls[stage] += calls
+
+# QFontMetrics are cached per thread (they are not thread-safe) and per
+# font. The caches are cleared when metrics_generation changes.
+metrics_cache = threading.local()
+metrics_generation = [0]
+
+def clear_font_metrics():
+    metrics_generation[0] += 1
+
+# Returns (QFontMetrics, half the width of 'M') for a font.
+def font_metrics(font):
+    try:
+        (generation, cache) = metrics_cache.value
+    except AttributeError:
+        generation = None
+    if generation != metrics_generation[0]:
+        cache = {}
+        metrics_cache.value = (metrics_generation[0], cache)
+
+    key = unicode(font.key())
+    try:
+        return cache[key]
+    except KeyError:
+        pass
+
+    fm = QtGui.QFontMetrics(font)
+    cache[key] = (fm, fm.charWidth('M', 0) / 2)
+    return cache[key]
+
+# Words of scripts that need no shaping (e.g., Chinese and Japanese) can be
+# composed from images of their characters ('tiles'), which are painted
+# once per character, font, and color. The Unicode blocks are configured
+# by 'tile_blocks' as hexadecimal ranges, and the least recently used
+# tiles are dropped once there are more than options['tile_cache_size'].
+tile_cache = OrderedDict()
+tile_lock = threading.Lock()
+
+# Parses u'3040-30ff, 4e00-9fff' into ((0x3040, 0x30ff), (0x4e00, 0x9fff)).
+def parse_tile_blocks(spec):
+    blocks = []
+    for block in spec.replace(u',', u' ').split():
+        (first, sep, last) = block.partition(u'-')
+        blocks.append((int(first, 16), int(last or first, 16)))
+    return tuple(blocks)
+
+def tileable(word, blocks):
+    if not blocks or not word:
+        return False
+    for c in word:
+        o = ord(c)
+        if not any(first <= o <= last for (first, last) in blocks):
+            return False
+    return True
+
+# Returns (advance, tile) for a character. A tile extends half_m to the
+# left and right of the character box for glyphs that overhang it.
+def glyph_tile(c, font, color, options):
+    key = (unicode(font.key()), color.rgba(), c)
+    with tile_lock:
+        try:
+            tile = tile_cache.pop(key)
+            tile_cache[key] = tile
+            return tile
+        except KeyError:
+            pass
+
+    (fm, half_m) = font_metrics(font)
+    text = QtCore.QString(c)
+    advance = fm.width(text)
+    height = fm.height()
+
+    img = QtGui.QImage(advance + 2 * half_m, height,
+                       QtGui.QImage.Format_ARGB32_Premultiplied)
+    img.fill(QtGui.qRgba(0,0,0,0))
+
+    p = QtGui.QPainter()
+    p.begin(img)
+    p.setBackgroundMode(QtCore.Qt.TransparentMode)
+    p.setRenderHint(QtGui.QPainter.Antialiasing +
+                    QtGui.QPainter.HighQualityAntialiasing +
+                    QtGui.QPainter.SmoothPixmapTransform)
+    p.setFont(font)
+    p.setPen(color)
+    p.drawText(QtCore.QRectF(half_m, 0, advance + half_m, height), text,
+               QtGui.QTextOption())
+    p.end()
+
+    with tile_lock:
+        tile_cache[key] = (advance, img)
+        while len(tile_cache) > options['tile_cache_size']:
+            tile_cache.popitem(last=False)
+    return (advance, img)
+
+# Palettes for the compact PNG modes: a ramp from the background to the
+# text color, with 256 steps ('indexed') or 2 steps ('mono').
+png_palettes = {}
+
+def png_palette(color, mode, transparent):
+    key = (color.rgb(), mode, transparent)
+    try:
+        return png_palettes[key]
+    except KeyError:
+        pass
+
+    (r, g, b) = (color.red(), color.green(), color.blue())
+    steps = [0, 255] if mode == 'mono' else range(256)
+    if transparent:
+        palette = [QtGui.qRgba(r, g, b, a) for a in steps]
+    else:
+        palette = [QtGui.qRgb(255 - (255 - r) * a // 255,
+                              255 - (255 - g) * a // 255,
+                              255 - (255 - b) * a // 255) for a in steps]
+
+    png_palettes[key] = palette
+    return palette
+
+def png_size(img, quality):
+    data = QtCore.QByteArray()
+    buf = QtCore.QBuffer(data)
+    buf.open(QtCore.QIODevice.WriteOnly)
+    img.save(buf, "PNG", quality)
+    buf.close()
+    return data.size()
+
+# Trim the columns at the left and right of an ARGB32 image that are all
+# background (if options['autocrop']), keeping its height so that the
+# baselines of adjacent images still line up, and compute a digest of its
+# pixels and of salt (if options['dedupe']). The pixels are looked at
+# through a NumPy view of the image data. Returns (image, pixels trimmed,
+# digest or '-').
+def trim_image(img, options, salt):
+    (width, height) = (img.width(), img.height())
+    bits = img.constBits()
+    bits.setsize(img.byteCount())
+    pixels = numpy.frombuffer(bits, numpy.uint32).reshape(
+        height, img.bytesPerLine() // 4)[:, :width]
+
+    (left, right) = (0, width)
+    if options['autocrop']:
+        background = 0 if options['transparent'] else 0xffffffff
+        used = numpy.flatnonzero((pixels != background).any(axis=0))
+        if len(used):
+            (left, right) = (int(used[0]), int(used[-1]) + 1)
+            pixels = pixels[:, left:right]
+
+    digest = "-"
+    if options['dedupe']:
+        digest = md5(("%s:%dx%d:" % (salt, right - left, height))
+                     .encode("utf-8") + pixels.tobytes()).hexdigest()
+
+    if (left, right) != (0, width):
+        img = img.copy(left, 0, right - left, height)
+    return (img, (width - (right - left)) * height, digest)
+
+# Write img to path in the configured PNG mode:
+#   'argb'      32-bit color with alpha channel (as painted)
+#   'indexed'   8-bit palette, a ramp from background to text color
+#   'mono'      1-bit palette, background or text color
+# The palette modes are only used for images of a single text color (when
+# color is given). Returns None on failure, and otherwise a tuple with the
+# number of bytes written, the number of bytes saved with respect to the
+# 'argb' mode at the default compression level, and the pixels trimmed and
+# the digest given by trim_image. Measuring the savings of the mode and
+# compression level takes a second encoding, which is only done if
+# options['stats'] or options['debug'] is set; otherwise only those of the
+# optimiser count.
+def save_image(img, path, options, color=None):
+    mode = options['png_mode']
+    quality = options['png_quality']
+    compare = bool(options['stats'] or options['debug'])
+
+    (trimmed, digest) = (0, "-")
+    if options['autocrop'] or options['dedupe']:
+        salt = mode
+        if mode in ('indexed', 'mono') and color is not None:
+            salt += "-%08x" % color.rgba()
+        (img, trimmed, digest) = trim_image(img, options, salt)
+
+    saved = 0
+    if mode in ('indexed', 'mono') and color is not None:
+        if compare:
+            saved = png_size(img, -1)
+        img = img.convertToFormat(
+            QtGui.QImage.Format_Mono if mode == 'mono'
+                else QtGui.QImage.Format_Indexed8,
+            png_palette(color, mode, options['transparent']))
+    elif quality != -1 and compare:
+        saved = png_size(img, -1)
+
+    # Write to a temporary file and rename it, so that an image is never
+    # seen half written.
+    tmppath = "%s.tmp-%d-%d" % (path, os.getpid(), thread_id())
+    if not img.save(tmppath, "PNG", quality):
+        remove_file(tmppath)
+        return None
+    written = os.path.getsize(tmppath)
+    if saved:
+        saved -= written
+
+    if options['png_optimiser']:
+        command = [a.replace('%s', tmppath)
+                   for a in options['png_optimiser'].split()]
+        try:
+            subprocess.call(command)
+            optimised = os.path.getsize(tmppath)
+            saved += written - optimised
+            written = optimised
+        except OSError:
+            pass
+
+    try:
+        os.rename(tmppath, path)
+    except OSError:
+        # on Windows, rename fails if another exporter was first
+        remove_file(tmppath)
+        if not os.path.exists(path):
+            return None
+
+    return (written, saved, trimmed, digest)
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+# The names of the images in a render directory, which may not exist,
+# without indexing it.
+def image_names(path):
+    names = set()
+    for (root, dirs, files) in os.walk(path):
+        names.update(name for name in files if name.endswith(".png"))
+    return names
+
+# Returns the md5 of the contents of a file, or None if it cannot be read.
+def file_md5(path):
+    digest = md5()
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                digest.update(chunk)
+    except (IOError, OSError):
+        return None
+    return digest.hexdigest()
+
+# Rendering an image is claimed, within this process, in a table shared by
+# all filters and threads, and, between processes, with a lock file next to
+# the image. Whoever holds the claim renders the image; the others wait and
+# use it. Lock files older than lock_timeout seconds are considered left
+# behind by a crashed exporter.
+claims = {}
+claims_lock = threading.Lock()
+lock_timeout = 60.0
+
+# Returns True if the lock on path was acquired and False if the image
+# was written by another process in the meantime.
+def acquire_lock_file(path):
+    lock = path + ".lock"
+    while True:
+        if os.path.exists(path):
+            return False
+        try:
+            os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            if os.path.exists(path):
+                remove_file(lock)
+                return False
+            return True
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
 
-def movenext(pos):
-    pos.movePosition(QTextCursor.NextCharacter, QTextCursor.KeepAnchor)
+        try:
+            if time.time() - os.stat(lock).st_mtime > lock_timeout:
+                remove_file(lock)
+                continue
+        except OSError:
+            continue
+        time.sleep(0.05)
+
+# Call paint for path, unless another thread or process renders the same
+# image. Returns the result of paint, rendered_elsewhere if the image was
+# rendered by someone else, or None on failure.
+rendered_elsewhere = (0, 0, 0, "-")
+
+def paint_claimed(paint, path, options, *args):
+    while True:
+        with claims_lock:
+            event = claims.get(path)
+            if event is None:
+                event = claims[path] = threading.Event()
+                break
+        event.wait()
+        if os.path.exists(path):
+            return rendered_elsewhere
+
+    try:
+        try:
+            if not acquire_lock_file(path):
+                return rendered_elsewhere
+        except OSError:
+            return None
+        try:
+            return paint(path, options, *args)
+        finally:
+            remove_file(path + ".lock")
+    finally:
+        with claims_lock:
+            del claims[path]
+        event.set()
+
+# Returns the (width, height) of the image for a word.
+def word_size(options, word, font, render_rtol):
+    (fm, half_m) = font_metrics(font)
+    width = fm.width(QtCore.QString(word)) + half_m
+    height = fm.height()
+
+    if render_rtol:
+        max_line_width = options['max_line_width']
+        lines = int(math.ceil(float(width) / float(max_line_width)))
+        width = min(width, max_line_width)
+        height = (height + fm.leading()) * lines
+
+    return (width, height)
+
+# Returns the (width, height) of the image for a line.
+def html_size(options, word, font):
+    (fm, half_m) = font_metrics(font)
+    width = fm.width(QtCore.QString(word)) + half_m
+
+    # add 25% to the width
+    max_line_width = options['max_line_width']
+    lines = int(math.ceil((float(width) * 1.25) / float(max_line_width)))
+    width = min(width, max_line_width)
+    height = (fm.height() + fm.leading()) * lines
+
+    return (width, height)
+
+# Must return None if the image could not be written to path, and
+# otherwise the tuple returned by save_image.
+def paint_word(path, options, word, font, color, render_rtol):
+    stats = options['stats']
+    if stats: t = clock()
+
+    # Render with Qt
+    text = QtCore.QString(word)
+
+    (fm, half_m) = font_metrics(font)
+    (width, height) = word_size(options, word, font, render_rtol)
+    tiles = not render_rtol and tileable(word, options['tile_blocks'])
+
+    option = QtGui.QTextOption()
+    if render_rtol:
+        option.setTextDirection(QtCore.Qt.RightToLeft)
+
+    tbox = QtCore.QRectF(0, 0, width, height)
+
+    # Alternative: calculate the bounding box from the text being rendered;
+    #              disadvantage = bad alignment of adjacent images.
+    #bbox = fm.boundingRect(text)
+    #width = bbox.width()
+    #height = bbox.height()
+
+    if options['debug']:
+        options['debug'](
+            "gogorender: rendering '%s' as a %dx%d image at %s"
+            % (text, width, height, path))
+    if stats: t = stats.add('measure', t)
+
+    img = QtGui.QImage(width, height, QtGui.QImage.Format_ARGB32)
+
+    if options['transparent']:
+        img.fill(QtGui.qRgba(0,0,0,0))
+    else:
+        img.fill(QtGui.qRgba(255,255,255,255))
+
+    p = QtGui.QPainter()
+    p.begin(img)
+    if tiles:
+        x = 0
+        for c in word:
+            (advance, tile) = glyph_tile(c, font, QtGui.QColor(color), options)
+            p.drawImage(QtCore.QPointF(x - half_m, 0), tile)
+            x += advance
+    else:
+        p.setBackgroundMode(QtCore.Qt.TransparentMode)
+        p.setRenderHint(QtGui.QPainter.Antialiasing +
+                        QtGui.QPainter.HighQualityAntialiasing +
+                        QtGui.QPainter.SmoothPixmapTransform)
+        p.setFont(font)
+        p.setPen(QtGui.QColor(color))
+        p.drawText(tbox, text, option)
+    p.end()
+    if stats: t = stats.add('paint', t)
+
+    result = save_image(img, path, options, QtGui.QColor(color))
+    if stats: stats.add('save', t)
+    return result
+
+# A document, an image and a painter for paint_html, kept per thread and
+# reused for every line. The image is only replaced by a larger one when
+# a line does not fit.
+class RenderContext(object):
+    def __init__(self):
+        self.doc = QTextDocument()
+        self.doc.setUndoRedoEnabled(False)
+        self.doc.setDocumentMargin(0.0)
+        self.doc.setIndentWidth(0.0)
+        self.doc.setUseDesignMetrics(True)
+        self.img = QtGui.QImage()
+        self.painter = QtGui.QPainter()
+
+    # Returns the document, emptied, for a line of html, which is either a
+    # string or a QTextDocumentFragment.
+    def document(self, html, font, width):
+        doc = self.doc
+        doc.clear()
+        doc.setDefaultFont(font)
+        doc.setTextWidth(width)
+        if isinstance(html, QtGui.QTextDocumentFragment):
+            QTextCursor(doc).insertFragment(html)
+        else:
+            doc.setHtml(html)
+        return doc
+
+    def image(self, width, height):
+        if self.img.width() < width or self.img.height() < height:
+            self.img = QtGui.QImage(max(width, self.img.width()),
+                                    max(height, self.img.height()),
+                                    QtGui.QImage.Format_ARGB32)
+        return self.img
+
+render_contexts = threading.local()
+
+def render_context():
+    try:
+        return render_contexts.value
+    except AttributeError:
+        render_contexts.value = RenderContext()
+        return render_contexts.value
+
+# Must return None if the image could not be written to path, and
+# otherwise the tuple returned by save_image. The html is a string or a
+# QTextDocumentFragment.
+def paint_html(path, options, word, html, font):
+    stats = options['stats']
+    if stats: t = clock()
+
+    (width, height) = html_size(options, word, font)
+    if stats: t = stats.add('measure', t)
+
+    # Render with Qt, adapted from:
+    # http://www.qtcentre.org/threads/11357-HTML-text-drawn-with-QPainter-drawText()
+    context = render_context()
+    doc = context.document(html, font, width)
+    if stats: t = stats.add('parse', t)
+
+    option = QtGui.QTextOption()
+    option.setTextDirection(QtCore.Qt.RightToLeft)
+
+    tbox = QtCore.QRectF(0, 0, width, height)
+
+    if options['debug']:
+        options['debug'](
+            "gogorender: rendering '%s' as a %dx%d image at %s"
+            % (word, width, height, path))
+
+    if options['transparent']:
+        background = QtGui.QColor(0, 0, 0, 0)
+    else:
+        background = QtGui.QColor(255, 255, 255, 255)
+
+    p = context.painter
+    p.begin(context.image(width, height))
+    p.setCompositionMode(QtGui.QPainter.CompositionMode_Source)
+    p.fillRect(tbox, background)
+    p.setCompositionMode(QtGui.QPainter.CompositionMode_SourceOver)
+    p.setClipRect(tbox)
+    p.setBackgroundMode(QtCore.Qt.TransparentMode)
+    p.setRenderHint(QtGui.QPainter.Antialiasing)
+    doc.drawContents(p, tbox)
+    p.end()
+    img = context.img.copy(0, 0, width, height)
+    if stats: t = stats.add('paint', t)
+
+    result = save_image(img, path, options)
+    if stats: stats.add('save', t)
+    return result
+
+# Jobs are sent to worker processes as tuples of plain values:
+#   ('word', word, font, rgba, render_rtol)
+#   ('html', word, html, font)
+# where font is the result of QFont.toString().
+def serialize_job(paint, args):
+    if paint is paint_word:
+        (word, font, color, render_rtol) = args
+        return ('word', unicode(word), unicode(font.toString()),
+                color.rgba(), bool(render_rtol))
+    else:
+        (word, html, font) = args
+        if isinstance(html, QtGui.QTextDocumentFragment):
+            html = html.toHtml()
+        return ('html', unicode(word), unicode(html),
+                unicode(font.toString()))
+
+def deserialize_font(font_string):
+    font = QtGui.QFont()
+    font.fromString(font_string)
+    return font
+
+# Worker processes need an application object of their own for fonts and
+# painting; under Qt 4 on X11, this is a GUI application with a display
+# connection of its own. Workers are therefore started as fresh processes
+# where possible. Where they can only be forked (Python 2 on Unix), they
+# inherit the application of the parent, which is only safe if it has no
+# display connection (e.g., a non-GUI application in a script); otherwise,
+# returns None and processes are not used.
+def render_process_context():
+    try:
+        return multiprocessing.get_context("spawn")
+    except (AttributeError, ValueError):
+        pass
+    if (sys.platform != 'win32'
+            and QtGui.QApplication.instance() is not None
+            and QtGui.QApplication.type() != QtGui.QApplication.Tty):
+        return None
+    return multiprocessing
+
+def init_render_process():
+    global worker_app
+    if QtGui.QApplication.instance() is None:
+        worker_app = QtGui.QApplication(["gogorender"])
+
+# Runs in a worker process: paint a batch of serialized jobs and return
+# (filename, result) for those that were written, and the stage totals if
+# options['stats'] is set.
+def paint_remote(batch):
+    (options, items) = batch
+    if options['stats']:
+        options = dict(options, stats=RenderStats())
+    done = []
+    for (filename, path, job) in items:
+        try:
+            if job[0] == 'word':
+                (kind, word, font, rgba, render_rtol) = job
+                result = paint_claimed(paint_word, path, options, word,
+                                       deserialize_font(font),
+                                       QtGui.QColor.fromRgba(rgba),
+                                       render_rtol)
+            else:
+                (kind, word, html, font) = job
+                result = paint_claimed(paint_html, path, options, word,
+                                       html, deserialize_font(font))
+        except Exception:
+            result = None
+        if result is not None:
+            done.append((filename, result))
+    return (done, options['stats'] and options['stats'].totals())
 
 class Gogorender(Filter):
     name = name
     version = version
     tag_re = re.compile("(<[^>]*>)")
+    batch_timeout = 120     # seconds, see render_in_processes
+    export_idle = 5000      # milliseconds, see begin_export
 
-    def __init__(self, component_manager):
+    # A filter with overrides is used for one of the extra scales of another,
+    # main_filter (see reconfigure), and the overrides replace the
+    # configured settings.
+    def __init__(self, component_manager, overrides=None, main_filter=None):
         Filter.__init__(self, component_manager)
-        self.reconfigure()
+        self.main_filter = main_filter
         self.debug = component_manager.debug_file != None
-
-        self.non_latin_font_size_increase = \
-                self.config()["non_latin_font_size_increase"]
+        self.pending = None
+        self.dry_run = None
+        self.overrides = dict(overrides or {})
+        self.variants = [self]
+        self.target = 0
+        self.stats = None
+        self.exporting = False      # between begin_export and end_export
+        self.export_cards = None    # ids of the cards of a detected export
+        self.export_timer = None
+        self.detect_exports = False # set for the 'mnemogogo' render chain
+        self.prerendering = False   # run() is called by GogorenderPrerender
+        self.workers = {'pool' : None, 'size' : 0, 'failed' : False}
+        self.reset_counters()
+        self.reconfigure()
 
     def setting(self, key):
         try:
             config = self.config()["gogorender"]
         except KeyError: config = {}
 
-        if key == 'imgpath':
+        if key in self.overrides:
+            return self.overrides[key]
+        elif key == 'imgpath':
             return os.path.join(self.database().media_dir(), "_gogorender")
         else:
             return config.get(key, default_config[key])
 
     def reconfigure(self):
-        self.imgpath = self.setting('imgpath')
-        if not os.path.exists(self.imgpath): os.mkdir(self.imgpath)
+        if self.exporting:
+            self.end_export()
+        elif hasattr(self, 'memo'):
+            self.flush()
+
+        self.configure()
+        if not os.path.exists(self.rootpath): os.mkdir(self.rootpath)
+        self.cache      = RenderCache(self.imgpath,
+                                      self.setting('cache_layout'))
+        self.check_stale_generations = True
+
+        # The memo depends on everything that changes the output of run()
+        # for a given text, font and tag; the images are covered by the
+        # generation.
+        self.memo_fingerprint = (version, self.generation,
+                                 self.cache.layout,
+                                 self.setting('render_char'),
+                                 self.setting('not_render_char'),
+                                 sorted(self.render_line_tags),
+                                 self.coalesce_words and self.coalesce_width,
+                                 self.scales)
+        if self.setting('memo_persist'):
+            memo_path = os.path.join(self.imgpath, "memo.json")
+        else:
+            memo_path = None
+        self.memo = RenderMemo(int(self.setting('memo_size')), memo_path)
+        self.memo.load(self.memo_fingerprint)
+
+        # Images at each of the extra scales are rendered, at the same time
+        # as those at font_scaling, by a filter of their own, which keeps
+        # them in its own generation (see run).
+        self.variants = [self]
+        for scale in self.scales:
+            if scale in [v.font_scaling for v in self.variants]:
+                continue
+            variant = Gogorender(self.component_manager,
+                                 dict(self.overrides, font_scaling=scale,
+                                      extra_scales=u'', memo_size=0,
+                                      memo_persist=False),
+                                 self)
+            variant.check_stale_generations = False
+            variant.counters = self.counters
+            variant.workers = self.workers
+            self.variants.append(variant)
+        self.target = 0
+
+    # Read the settings, without touching the render directory (see
+    # estimate).
+    def configure(self):
+        main = self.main_filter
+        if main is not None:
+            self.stats = main.stats
+        elif not self.setting('collect_stats'):
+            self.stats = None
+        elif self.stats is None:
+            self.stats = RenderStats()
 
         self.transparent        = self.setting('transparent')
+        self.font_scaling       = float(self.setting('font_scaling'))
+        self.non_latin_font_size_increase = \
+                self.config()["non_latin_font_size_increase"]
         self.render_char_re     = QRegExp(self.setting('render_char'))
         self.render_line_tags   = {t.strip()
                 for t in self.setting('render_line_tags').split(',')}
         self.not_render_char_re = QRegExp(self.setting('not_render_char'))
         self.not_word_re        = QRegExp(not_word)
         self.not_line_re        = QRegExp(not_line)
+        self.class_regexps      = ((self.render_char_re, RENDER),
+                                   (self.not_render_char_re, NOT_RENDER),
+                                   (self.not_word_re, NOT_WORD),
+                                   (self.not_line_re, NOT_LINE))
+        # the variants of the extra scales have the same character
+        # settings, and share the table, which takes a while to build
+        if main is None:
+            self.class_table    = class_table(self.class_regexps)
+        else:
+            self.class_table    = main.class_table
+        self.char_classes       = {}
+        self.fonts              = {}
+        clear_font_metrics()
+
+        try:
+            self.tile_blocks = parse_tile_blocks(self.setting('tile_blocks'))
+        except ValueError:
+            self.tile_blocks = ()
+            if self.debug:
+                self.component_manager.debug(
+                    "gogorender: ignoring invalid tile_blocks '%s'"
+                    % self.setting('tile_blocks'))
+
+        # A character class for a quick check on the raw text, before any
+        # Qt work. It must never miss a character that segment() would
+        # start a word at, but may find characters that it would not.
+        if main is None:
+            self.prefilter_re = table_re(self.class_table, RENDER,
+                                         NOT_RENDER | NOT_LINE)
+        else:
+            self.prefilter_re = main.prefilter_re
         self.max_line_width     = int(self.setting('max_line_width'))
+        self.render_threads     = (int(self.setting('render_threads'))
+                                   or QtCore.QThread.idealThreadCount())
+        self.render_processes   = int(self.setting('render_processes'))
+
+        self.rootpath   = self.setting('imgpath')
+        self.autocrop   = bool(self.setting('autocrop')) and numpy is not None
+        self.dedupe     = bool(self.setting('dedupe')) and numpy is not None
+        if self.debug and numpy is None and (self.setting('autocrop')
+                                             or self.setting('dedupe')):
+            self.component_manager.debug(
+                "gogorender: autocrop and dedupe need numpy")
+        self.generation = generation_name(self.transparent, self.font_scaling,
+                                          self.max_line_width,
+                                          self.non_latin_font_size_increase,
+                                          self.setting('png_mode'),
+                                          self.autocrop)
+        self.imgpath    = os.path.join(self.rootpath, self.generation)
+        self.relpath    = "_gogorender" + "/" + self.generation
 
-    def debugline(self, msg, pos):
+        try:
+            self.scales = [float(scale) for scale in
+                           self.setting('extra_scales').replace(u',', u' ')
+                                                       .split()]
+        except ValueError:
+            self.scales = []
+            if self.debug:
+                self.component_manager.debug(
+                    "gogorender: ignoring invalid extra_scales '%s'"
+                    % self.setting('extra_scales'))
+        self.coalesce_words = bool(self.setting('coalesce_words'))
+        self.coalesce_width = (int(self.setting('coalesce_width'))
+                               or self.max_line_width)
+
+        self.options = {
+            'transparent'    : self.transparent,
+            'max_line_width' : self.max_line_width,
+            'debug'          : self.debug and self.component_manager.debug,
+            'png_mode'       : self.setting('png_mode'),
+            'png_quality'    : png_quality(int(self.setting('png_compression'))),
+            'png_optimiser'  : self.setting('png_optimiser'),
+            'stats'          : self.stats,
+            'tile_blocks'    : self.tile_blocks,
+            'tile_cache_size': int(self.setting('tile_cache_size')),
+            'autocrop'       : self.autocrop,
+            'dedupe'         : self.dedupe,
+        }
+
+    def select_scale(self, scale=None):
+        """Choose the scale, font_scaling (if None) or one of 'extra_scales',
+        whose images run() refers to. The render argument gogorender_scale
+        does the same for a single call."""
+        self.target = self.variant_index(scale)
+
+    def variant_index(self, scale):
+        if scale is None:
+            return 0
+        for (i, variant) in enumerate(self.variants):
+            if abs(variant.font_scaling - float(scale)) < 1e-6:
+                return i
+        if self.debug:
+            self.component_manager.debug(
+                "gogorender: scale %s is not configured" % scale)
+        return 0
+
+    # A copy of a font from segment() at the size for a scale.
+    def scaled_font(self, font, scale):
+        font = QtGui.QFont(font)
+        font.setPointSizeF((font.pointSize()
+                            + self.non_latin_font_size_increase) * scale)
+        return font
+
+    def flush(self):
+        """Save state that is kept between sessions."""
+        self.memo.save(self.memo_fingerprint)
+
+    def reset_counters(self):
+        if self.stats:
+            self.stats.reset()
+        self.counters = {
+            'fields'         : 0,   # calls to run()
+            'fields_skipped' : 0,   # ... that returned after the prefilter
+            'fields_memo'    : 0,   # ... that were found in the memo
+            'cache_hits'     : 0,   # words whose image already existed
+            'cache_misses'   : 0,   # ... and those that had to be rendered
+            'images'         : 0,   # images rendered
+            'bytes_written'  : 0,   # ... and their total size
+            'bytes_saved'    : 0,   # ... and savings (see save_image)
+            'images_removed' : 0,   # images evicted or swept by end_export
+            'images_shared'  : 0,   # images identical to an existing one
+            'pixels_trimmed' : 0,   # empty columns removed by 'autocrop'
+        }
+        for variant in self.variants[1:]:
+            variant.counters = self.counters
+
+    def get_stats(self):
+        """Return the counters and, if 'collect_stats' is set, the time
+        and number of calls of each stage of rendering, as
+        {stage : (seconds, calls)} under the key 'stages'. Everything is
+        accumulated since the last reset_counters(), which begin_export()
+        calls, so that the numbers are those of the current or last
+        export."""
+        stats = dict(self.counters)
+        if self.stats:
+            stats['stages'] = self.stats.totals()
+        return stats
+
+    def stats_summary(self):
+        """Return get_stats() as a single line of text."""
+        c = self.counters
+        words = c['cache_hits'] + c['cache_misses']
+        line = ("%d fields (%d skipped, %d memo), %d words (%d%% hits),"
+                " %d images (%d shared), %d bytes (%d saved),"
+                " %d pixels trimmed"
+                % (c['fields'], c['fields_skipped'], c['fields_memo'],
+                   words, 100 * c['cache_hits'] // max(words, 1),
+                   c['images'], c['images_shared'], c['bytes_written'],
+                   c['bytes_saved'], c['pixels_trimmed']))
+        if self.stats:
+            totals = self.stats.totals()
+            line += "; " + ", ".join("%s %.3fs/%d" % ((stage,) + totals[stage])
+                                     for stage in RenderStats.stages)
+        return line
+
+    # Write the summary to the debug log, or to stderr if only the stages
+    # are being timed. This is done at the end of every export, and by
+    # run_batch and run_stream outside of exports.
+    def report(self):
+        if self.debug:
+            self.component_manager.debug("gogorender: " + self.stats_summary())
+        elif self.stats:
+            sys.stderr.write("gogorender: %s\n" % self.stats_summary())
+
+    # Returns False if text certainly contains nothing to render.
+    def prefilter(self, text):
+        plain = self.tag_re.sub(u'', text)
+        if u'&' in plain:
+            plain = unescape_html(plain)
+
+        return self.prefilter_re.search(plain) is not None
+
+    # Returns (font_string, font) for a field of a card type, where font is
+    # None if the card type does not set one. Parsed fonts are cached per
+    # card type and field, and parsed again if the font string changes.
+    def card_font(self, card_type, proxy_key):
+        font_string = self.config().card_type_property(
+            "font", card_type, proxy_key)
+
+        key = (card_type.id, proxy_key)
+        try:
+            (cached_string, font) = self.fonts[key]
+            if cached_string == font_string:
+                return (font_string, font)
+        except KeyError:
+            pass
+
+        if font_string:
+            family,size,x,x,weight,italic,u,s,x,x = font_string.split(",")
+            font = QtGui.QFont(family, int(size), int(weight), bool(int(italic)))
+        else:
+            font = None
+
+        self.fonts[key] = (font_string, font)
+        return (font_string, font)
+
+    def debugline(self, msg, position, c):
         if self.debug:
-            s = pos.selectedText()
-            try:
-                c = ord(unicode(s[-1]))
-            except IndexError: c = 0
             self.component_manager.debug(
                 u'gogorender: %s pos=%d char="%s" (0x%04x)'
-                % (msg, pos.position(), s, c))
+                % (msg, position, c, ord(c[0])))
+
+    # Character classes come from the table built by reconfigure(), and,
+    # for the characters it does not cover, from the patterns themselves.
+    def char_class(self, c):
+        o = ord(c)
+        if o < 0x10000:
+            cls = self.class_table[o]
+            if cls != UNCLASSIFIED:
+                return cls
+
+        try:
+            return self.char_classes[c]
+        except KeyError:
+            pass
+
+        cls = classify(c, self.class_regexps)
+        self.char_classes[c] = cls
+        return cls
+
+    # Returns (text, where, runs, formats) for a QTextBlock, where text is
+    # the text of the block, where[i] is the document position of text[i]
+    # (where[len(text)] is the end of the block), runs[i] indexes the
+    # (font, color) pair of text[i] in formats. Adjacent fragments with the
+    # same font and color share a run.
+    def block_runs(self, block):
+        parts = []
+        where = []
+        runs = []
+        formats = []
+
+        it = block.begin()
+        while not it.atEnd():
+            frag = it.fragment()
+            if frag.isValid():
+                t = unicode(frag.text())
+                fmt = frag.charFormat()
+                format = (fmt.font(), fmt.foreground().color())
+                if not formats or formats[-1] != format:
+                    formats.append(format)
+                runs.extend([len(formats) - 1] * len(t))
+
+                p = frag.position()
+                if len(t) == frag.length():
+                    where.extend(range(p, p + len(t)))
+                else:
+                    # characters outside the BMP take two positions
+                    for c in t:
+                        where.append(p)
+                        p += 2 if ord(c) > 0xffff else 1
+                parts.append(t)
+            it += 1
+        where.append(block.position() + block.length() - 1)
+
+        return (u''.join(parts), where, runs, formats)
+
+    # Yields (start, end, word, font, color, gap) for every word in doc that
+    # is to be rendered, where start and end are document positions.
+    #
+    # A word starts at a character that matches render_char (but neither
+    # not_render_char nor the word separators) and extends in both
+    # directions over characters that are not word separators, and, unless
+    # whole lines are rendered, have the same font and color.
+    #
+    # If the previous word is in the same block and has the same font and
+    # color as the characters up to this one, which are not line
+    # separators, gap is the text between them, and otherwise None.
+    def segment(self, doc, render_line):
+        stop = NOT_LINE if render_line else NOT_WORD
+        char_class = self.char_class
+
+        block = doc.begin()
+        while block.isValid():
+            (text, where, runs, formats) = self.block_runs(block)
+            n = len(text)
+            previous = None     # end of the previous word in the block
+
+            i = 0
+            while i < n:
+                cls = char_class(text[i])
+                if not cls & RENDER:
+                    i += 1
+                    continue
+
+                if cls & (NOT_RENDER | stop):
+                    self.debugline("skip", where[i], text[i])
+                    # as in the earlier cursor-based search, the character
+                    # after a skipped one never starts a word
+                    i += 2
+                    continue
+
+                run = runs[i]
+                j = i
+                while (j > 0 and not char_class(text[j - 1]) & stop
+                        and (render_line or runs[j - 1] == run)):
+                    j -= 1
+                k = i + 1
+                while (k < n and not char_class(text[k]) & stop
+                        and (render_line or runs[k] == run)):
+                    k += 1
+
+                # runs are numbered in order, so the characters between two
+                # of the same run are of that run too
+                gap = None
+                if previous is not None and runs[previous - 1] == run:
+                    gap = text[previous:j]
+                    if [c for c in gap if char_class(c) & NOT_LINE]:
+                        gap = None
+
+                (font, color) = formats[run]
+                yield (where[j], where[k], text[j:k], QtGui.QFont(font), color,
+                       gap)
+                previous = i = k
+
+            block = block.next()
 
     # Must return one of:
     #   None            not rendered after all
@@ -238,263 +1893,934 @@ class Gogorender(Filter):
         filename = "%s-%s-%s-%s-%s" % (
             fword, fontname, str(fontsize), style, colorname)
         filename = md5(filename.encode("utf-8")).hexdigest() + ".png"
-        path = os.path.join(self.imgpath, filename)
-        relpath = "_gogorender" + "/" + filename
-
-        if (os.path.exists(path)):
-            return relpath
-
-        # Render with Qt
-        text = QtCore.QString(word)
-
-        fm = QtGui.QFontMetrics(font)
-        width = fm.width(text) + (fm.charWidth('M', 0) / 2)
-        height = fm.height()
-
-        option = QtGui.QTextOption()
-        if render_rtol:
-            lines = int(math.ceil(float(width) / float(self.max_line_width)))
-            width = min(width, self.max_line_width)
-            height = (height + fm.leading()) * lines
-            option.setTextDirection(QtCore.Qt.RightToLeft)
-
-        tbox = QtCore.QRectF(0, 0, width, height)
-
-        # Alternative: calculate the bounding box from the text being rendered;
-        #              disadvantage = bad alignment of adjacent images.
-        #bbox = fm.boundingRect(text)
-        #width = bbox.width()
-        #height = bbox.height()
-
-        if self.debug:
-            self.component_manager.debug(
-                "gogorender: rendering '%s' as a %dx%d image at %s"
-                % (text, width, height, path))
 
-        img = QtGui.QImage(width, height, QtGui.QImage.Format_ARGB32)
-
-        if self.transparent:
-            img.fill(QtGui.qRgba(0,0,0,0))
-        else:
-            img.fill(QtGui.qRgba(255,255,255,255))
-
-        p = QtGui.QPainter()
-        p.begin(img)
-        p.setBackgroundMode(QtCore.Qt.TransparentMode)
-        p.setRenderHint(QtGui.QPainter.Antialiasing +
-                        QtGui.QPainter.HighQualityAntialiasing +
-                        QtGui.QPainter.SmoothPixmapTransform)
-        p.setFont(font)
-        p.setPen(QtGui.QColor(color))
-        p.drawText(tbox, text, option)
-        p.end()
-
-        if img.save(path, "PNG"):
-            return relpath
-        else:
-            return None
+        return self.render_cached(filename, paint_word,
+                                  (word, font, color, render_rtol))
 
     # Must return one of:
     #   None            not rendered after all
     #   path            a path to the rendered image
     def render_html(self, word, html, font):
         filename = md5(word.encode("utf-8")).hexdigest() + "-html.png"
-        path = os.path.join(self.imgpath, filename)
-        relpath = "_gogorender" + "/" + filename
-
-        if (os.path.exists(path)):
-            return relpath
+        return self.render_cached(filename, paint_html, (word, html, font))
 
-        text = QtCore.QString(word)
-        fm = QtGui.QFontMetrics(font)
-        width = fm.width(text) + (fm.charWidth('M', 0) / 2)
-
-        # add 25% to the width
-        lines = int(math.ceil((float(width) * 1.25) / float(self.max_line_width)))
-        width = min(width, self.max_line_width)
-        height = (fm.height() + fm.leading()) * lines
+    # Must return one of:
+    #   None            not rendered after all
+    #   path            a path to the rendered image
+    #
+    # In batch mode (self.pending is not None), missing images are only
+    # recorded and the path is returned as if rendering had succeeded. In a
+    # dry run (self.dry_run is not None), all images are only recorded.
+    def render_cached(self, filename, paint, args):
+        if self.dry_run is not None:
+            self.dry_run.setdefault(filename, (paint, args))
+            return self.image_path(filename)
+
+        if filename in self.cache:
+            self.cache.touch(filename)
+            self.counters['cache_hits'] += 1
+            return self.image_path(filename)
+        self.counters['cache_misses'] += 1
+
+        if self.pending is not None:
+            self.pending.setdefault(filename, (paint, args))
+            return self.image_path(filename)
+
+        self.remove_stale_generations()
+        path = self.cache.filepath(filename)
+        result = paint_claimed(paint, path, self.options, *args)
+        if result is not None:
+            self.written(filename, result)
+            return self.image_path(filename)
+        else:
+            return None
 
-        # Render with Qt, adapted from:
-        # http://www.qtcentre.org/threads/11357-HTML-text-drawn-with-QPainter-drawText()
-        doc = QTextDocument()
-        doc.setUndoRedoEnabled(False)
-        doc.setHtml(html)
-        doc.setTextWidth(width)
-        doc.setDocumentMargin(0.0)
-        doc.setIndentWidth(0.0)
-        doc.setUseDesignMetrics(True)
-        doc.setDefaultFont(font)
+    # The path of an image relative to the media directory.
+    def image_path(self, filename):
+        return (self.relpath + "/"
+                + self.cache.subpath(self.cache.resolve(filename)))
+
+    # Record an image written by one of the paint functions.
+    def written(self, filename, result):
+        (nbytes, saved, trimmed, digest) = result
+        if nbytes:
+            name = self.cache.add(filename, nbytes, digest)
+            self.counters['images'] += 1
+        else:       # rendered by another exporter
+            path = self.cache.filepath(filename)
+            name = self.cache.add(filename, os.path.getsize(path))
+        if name != filename:
+            self.counters['images_shared'] += 1
+            self.counters['bytes_saved'] += nbytes
+        else:
+            self.counters['bytes_written'] += nbytes
+        self.counters['pixels_trimmed'] += trimmed
+        self.counters['bytes_saved'] += saved
+
+    def remove_stale_generations(self):
+        """Delete everything in the render directory that does not belong
+        to the current generations. This is done lazily, just before the
+        first image is rendered into a generation, so that settings that
+        are changed and changed back do not cost a full re-render."""
+        if not self.check_stale_generations:
+            return
+        self.check_stale_generations = False
+
+        keep = {variant.generation for variant in self.variants}
+        keep.add(export_counter)
+        for name in os.listdir(self.rootpath):
+            if name in keep:
+                continue
+            path = os.path.join(self.rootpath, name)
+            if self.debug:
+                self.component_manager.debug(
+                    "gogorender: removing stale %s" % path)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+
+    def render_jobs(self, jobs, threads=None, processes=None):
+        """Render a mapping from file names to (paint, args) jobs, on a pool
+        of worker processes if configured and otherwise (or for the jobs
+        that failed there) on a pool of threads. Returns the set of file
+        names that could not be rendered."""
+        if processes is None:
+            processes = self.render_processes
+        if self.workers['failed']:
+            processes = 0
+
+        if jobs:
+            self.remove_stale_generations()
+
+        failed = set(jobs)
+        if processes > 0 and jobs:
+            failed -= self.render_in_processes(jobs, processes)
+        if failed:
+            failed -= self.render_in_threads(
+                {f : jobs[f] for f in failed}, threads)
+
+        return failed
+
+    def render_in_threads(self, jobs, threads=None):
+        if threads is None:
+            threads = self.render_threads
+        threads = max(1, min(threads, len(jobs)))
+        # Qt draws unreadable text outside of the GUI thread on platforms
+        # without threaded font rendering (e.g., X11 without fontconfig)
+        if not QtGui.QFontDatabase.supportsThreadedFontRendering():
+            threads = 1
+
+        todo = queue.Queue()
+        for item in jobs.items():
+            todo.put(item)
+        done = []
+
+        def work():
+            while True:
+                try:
+                    (filename, (paint, args)) = todo.get_nowait()
+                except queue.Empty:
+                    return
+                path = self.cache.filepath(filename)
+                result = paint_claimed(paint, path, self.options, *args)
+                if result is not None:
+                    done.append((filename, result))
+
+        if threads == 1:
+            work()
+        else:
+            workers = [threading.Thread(target=work) for i in range(threads)]
+            for w in workers: w.start()
+            for w in workers: w.join()
+
+        for (filename, result) in done:
+            self.written(filename, result)
+
+        return {filename for (filename, result) in done}
+
+    # The pool of worker processes is shared by the filters of all scales
+    # and kept until close_workers(). A worker that dies (e.g., Qt aborts)
+    # is replaced by the pool, but its batch is lost: batches not done
+    # within batch_timeout seconds of the previous one are left to
+    # render_in_threads. Once the pool fails, processes are not used
+    # again.
+    def render_in_processes(self, jobs, processes):
+        workers = self.workers
+        if workers['pool'] is not None and workers['size'] != processes:
+            self.close_workers()
+
+        if workers['pool'] is None:
+            context = render_process_context()
+            if context is None:
+                if self.debug:
+                    self.component_manager.debug(
+                        "gogorender: not forking render processes from a GUI"
+                        " application")
+                workers['failed'] = True
+                return set()
+            try:
+                workers['pool'] = context.Pool(processes, init_render_process)
+                workers['size'] = processes
+            except Exception as e:
+                if self.debug:
+                    self.component_manager.debug(
+                        "gogorender: cannot start render processes (%s)" % e)
+                workers['failed'] = True
+                return set()
 
-        option = QtGui.QTextOption()
-        option.setTextDirection(QtCore.Qt.RightToLeft)
+        options = dict(self.options, debug=None, stats=bool(self.stats))
+        items = [(filename, self.cache.filepath(filename),
+                  serialize_job(paint, args))
+                 for (filename, (paint, args)) in jobs.items()]
 
-        tbox = QtCore.QRectF(0, 0, width, height)
+        nbatches = min(len(items), processes * 4)
+        batches = [(options, items[i::nbatches]) for i in range(nbatches)]
 
+        done = []
+        try:
+            pending = [workers['pool'].apply_async(paint_remote, (batch,))
+                       for batch in batches]
+            last = time.time()
+            while pending:
+                pending[0].wait(0.1)
+                ready = [r for r in pending if r.ready()]
+                if ready:
+                    last = time.time()
+                elif time.time() - last > self.batch_timeout:
+                    raise multiprocessing.TimeoutError(
+                        "no batch done in %d s" % self.batch_timeout)
+                for r in ready:
+                    pending.remove(r)
+                    (results, totals) = r.get()
+                    done.extend(results)
+                    if totals:
+                        self.stats.merge(totals)
+        except Exception as e:
+            if self.debug:
+                self.component_manager.debug(
+                    "gogorender: render processes failed (%s)" % e)
+            self.close_workers()
+            workers['failed'] = True
+
+        for (filename, result) in done:
+            self.written(filename, result)
+
+        return {filename for (filename, result) in done}
+
+    def close_workers(self):
+        """Stop the worker processes, if any."""
+        pool = self.workers['pool']
+        self.workers['pool'] = None
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    def begin_export(self):
+        """Start an export. Returns its number.
+
+        Every image referred to by a rendered field is marked as used by
+        the current export, which end_export() uses to clean up the cache.
+
+        An exporter may call begin_export() before rendering the cards and
+        end_export() after. Otherwise, exports through the 'mnemogogo'
+        render chain are detected (but not the reviews rendered through
+        the 'default' chain, if it is used): the first call to run() outside
+        of an export begins one, which ends once the application has been
+        idle for export_idle milliseconds. Such an export is complete if
+        it rendered every card in the database.
+        """
+        if self.export_timer is not None:
+            self.export_timer.stop()
+        self.exporting = True
+        self.export_cards = None
+        self.reset_counters()
+
+        for variant in self.variants:
+            variant.cache.refresh(force=True)
+
+        # the caches of all scales share the export numbers, which come
+        # from a counter in the render directory, so that a number is never
+        # used again by a later generation
+        counter = os.path.join(self.rootpath, export_counter)
+        try:
+            with open(counter, "r") as f:
+                last = int(f.read().split()[0])
+        except (IOError, OSError, ValueError, IndexError):
+            last = 0
+        export = max([last] + [variant.cache.export
+                               for variant in self.variants]) + 1
+        with open(counter + ".tmp", "w") as f:
+            f.write("%d\n" % export)
+        remove_file(counter)
+        os.rename(counter + ".tmp", counter)
+
+        for variant in self.variants:
+            variant.cache.begin_export(export)
+        return export
+
+    def end_export(self, complete=False):
+        """End an export. If complete, i.e., every card was rendered since
+        begin_export(), the images that were not referred to are deleted.
+        Then, if the caches of all scales together are larger than
+        'cache_max_bytes', the least recently exported images are deleted,
+        from each cache in proportion to its size.
+
+        The images that the export referred to are recorded for
+        export_changes(). An export that referred to no image at all is
+        not recorded, and leaves the cache as it was."""
+        if self.export_timer is not None:
+            self.export_timer.stop()
+        self.exporting = False
+        self.export_cards = None
+
+        removed = 0
+        max_bytes = int(self.setting('cache_max_bytes'))
+        if not any(variant.cache.referenced() for variant in self.variants):
+            for variant in self.variants:
+                variant.cache.cancel_export()
+        else:
+            for variant in self.variants:
+                variant.cache.record_export()
+                if complete:
+                    removed += variant.cache.sweep()
+            total = sum(variant.cache.total_size()
+                        for variant in self.variants)
+            for variant in self.variants:
+                if 0 < max_bytes < total:
+                    removed += variant.cache.evict(
+                        max_bytes * variant.cache.total_size() // total)
+                variant.cache.save()
+
+        self.counters['images_removed'] += removed
+        self.flush()
         if self.debug:
             self.component_manager.debug(
-                "gogorender: rendering '%s' as a %dx%d image at %s"
-                % (word, width, height, path))
+                "gogorender: export %d removed %d images, cache is %d bytes"
+                % (self.cache.export, removed, self.cache.total_size()))
+        self.report()
+
+    # Called by run(): begin an export, or extend a detected one.
+    def export_activity(self, card):
+        if not self.exporting:
+            self.begin_export()
+            self.export_cards = set()
+        if self.export_cards is None:
+            return
+
+        self.export_cards.add(card.id)
+        if self.export_timer is None:
+            self.export_timer = QtCore.QTimer()
+            self.export_timer.setSingleShot(True)
+            self.export_timer.setInterval(self.export_idle)
+            self.export_timer.timeout.connect(self.end_detected_export)
+        self.export_timer.start()
+
+    def end_detected_export(self):
+        if self.export_cards is None:
+            return
+        database = self.database()
+        complete = (database.is_loaded()
+                    and len(self.export_cards) >= database.card_count())
+        self.end_export(complete)
+
+    def export_changes(self, since, scale=None):
+        """Return the changes to the images between export number since
+        and the last export, at font_scaling or at one of 'extra_scales',
+        for syncing only the changed files to a device. Returns a pair of
+        lists: (path, size, md5) for the images that were added or changed,
+        and the paths of those that are no longer referred to, with paths
+        relative to the media directory. Export numbers are never reused,
+        even by a new generation of images. Returns None if either export
+        was not recorded in the current generation, e.g., because the
+        settings changed since, in which case everything must be synced."""
+        variant = self.variants[self.variant_index(scale)]
+        changes = variant.cache.changes_since(since)
+        if changes is None:
+            return None
 
-        img = QtGui.QImage(width, height, QtGui.QImage.Format_ARGB32)
-        if self.transparent:
-            img.fill(QtGui.qRgba(0,0,0,0))
-        else:
-            img.fill(QtGui.qRgba(255,255,255,255))
+        (added, removed) = changes
+        prefix = variant.relpath + "/"
+        return ([(prefix + subpath, size, md5sum)
+                 for (subpath, size, md5sum) in added],
+                [prefix + subpath for subpath in removed])
+
+    def collect_jobs(self, render):
+        """Call render(), which runs this filter (e.g., through its render
+        chain), outside of any export and with the missing images recorded
+        instead of painted. Returns them as a list of (variant, file name,
+        job), where variant is this filter or that of one of the extra
+        scales, to be painted one at a time by paint_job()."""
+        for variant in self.variants:
+            variant.pending = {}
+        self.prerendering = True
+        try:
+            render()
+            return [(variant, filename, job) for variant in self.variants
+                    for (filename, job) in variant.pending.items()]
+        finally:
+            self.prerendering = False
+            for variant in self.variants:
+                variant.pending = None
+
+    def paint_job(self, variant, filename, job):
+        """Paint an image collected by collect_jobs(), in this thread,
+        unless it was rendered in the meantime or the settings changed."""
+        if variant in self.variants and filename not in variant.cache:
+            variant.render_jobs({filename : job}, 1, 0)
+
+    def run_batch(self, fields, threads=None, processes=None):
+        """Render a sequence of (text, card, fact_key) triples.
+
+        All fields are scanned first and the images they need are collected,
+        each distinct (word, font, color, rtl) key only once. The missing
+        images are then rendered by render_jobs() and, in a final pass,
+        the fields that refer to images that could not be rendered are run
+        again. Returns the list of rendered texts."""
+        results = self.render_window(list(fields), threads, processes)
+        if not self.exporting:
+            self.report()
+        self.flush()
+        return results
+
+    def run_stream(self, fields, window=None, progress=None, cancel=None,
+                   threads=None, processes=None):
+        """Render an iterable of (text, card, fact_key) triples, yielding
+        the rendered texts in order.
+
+        The fields are read and rendered as by run_batch(), but in windows
+        of at most 'window' fields ('stream_window' by default), so that
+        memory does not grow with the number of fields. After each window,
+        progress(fields, images, bytes), if given, is called with the
+        numbers of fields done and of images and bytes written so far.
+        Before each window, cancel(), if given, is called, and rendering
+        stops if it returns True. The caller can also stop iterating."""
+        if window is None:
+            window = int(self.setting('stream_window'))
+        window = max(window, 1)
+
+        # the totals are kept from the counts of each window, since the
+        # first window may begin an export, which resets the counters
+        fields = iter(fields)
+        (done, images, nbytes) = (0, 0, 0)
+        try:
+            while not (cancel and cancel()):
+                chunk = list(islice(fields, window))
+                if not chunk:
+                    break
+                counters = self.counters
+                before = (counters['images'], counters['bytes_written'])
+                results = self.render_window(chunk, threads, processes)
+                if self.counters is not counters:
+                    before = (0, 0)
+                done += len(chunk)
+                images += self.counters['images'] - before[0]
+                nbytes += self.counters['bytes_written'] - before[1]
+                if progress:
+                    progress(done, images, nbytes)
+                for text in results:
+                    yield text
+        finally:
+            if not self.exporting:
+                self.report()
+            self.flush()
+
+    # The work of run_batch for a list of fields.
+    def render_window(self, fields, threads, processes):
+        skipped = self.counters['fields_skipped']
+
+        for variant in self.variants:
+            variant.pending = {}
+        try:
+            results = [self.run(text, card, fact_key)
+                       for (text, card, fact_key) in fields]
+            jobs = [(variant, variant.pending) for variant in self.variants]
+        finally:
+            for variant in self.variants:
+                variant.pending = None
 
-        p = QtGui.QPainter()
-        p.begin(img)
-        p.setBackgroundMode(QtCore.Qt.TransparentMode)
-        p.setRenderHint(QtGui.QPainter.Antialiasing)
-        doc.drawContents(p, tbox)
-        p.end()
+        images = self.counters['images']
+        nbytes = self.counters['bytes_written']
+        saved = self.counters['bytes_saved']
 
-        if img.save(path, "PNG"):
-            return relpath
-        else:
-            return None
+        if self.debug:
+            self.component_manager.debug(
+                "gogorender: batch of %d fields needs %d new images"
+                " (%d fields skipped by the prefilter)"
+                % (len(fields), sum(len(j) for (v, j) in jobs),
+                   self.counters['fields_skipped'] - skipped))
+
+        # rerun the fields with images that failed or turned out to be
+        # identical to another (whose path was not known when scanning)
+        failed = set()
+        for (variant, vjobs) in jobs:
+            failed |= variant.render_jobs(vjobs, threads, processes)
+            failed |= {f for f in vjobs if variant.cache.resolve(f) != f}
+        if failed:
+            for (i, (text, card, fact_key)) in enumerate(fields):
+                if [f for f in failed if f in results[i]]:
+                    results[i] = self.run(text, card, fact_key)
 
+        if self.debug:
+            self.component_manager.debug(
+                "gogorender: wrote %d images, %d bytes (%d bytes saved)"
+                % (self.counters['images'] - images,
+                   self.counters['bytes_written'] - nbytes,
+                   self.counters['bytes_saved'] - saved))
+        return results
+
+    def estimate(self, fields, overrides=None):
+        """Estimate the work of rendering a sequence of (text, card,
+        fact_key) triples, without rendering them.
+
+        The fields are segmented as by run(), but the images are only
+        measured. To estimate the bytes and time per image, at most
+        'estimate_sample' of the missing images are painted into a
+        temporary directory. The settings in overrides, a dictionary,
+        replace the configured ones for the estimate. Returns a dictionary
+        with the numbers of fields, unique images, images already cached,
+        the pixels of all images and of the missing ones, and the bytes
+        and seconds needed to render the missing images."""
+        # The settings are only read again (see configure); the cache, the
+        # memo and everything else of the filter are left as they are, and
+        # all attributes are restored afterwards.
+        saved = dict(self.__dict__)
+        try:
+            if overrides:
+                self.overrides = dict(self.overrides, **overrides)
+                self.configure()
+            if self.generation == saved['generation']:
+                cached = self.cache
+                cached.refresh()
+            else:
+                cached = image_names(self.imgpath)
+            self.variants = [self]
+            self.target = 0
+            self.counters = dict(self.counters)
+            self.memo = RenderMemo(0)
+            self.stats = None
+
+            nfields = 0
+            self.dry_run = {}
+            try:
+                for (text, card, fact_key) in fields:
+                    self.run(text, card, fact_key)
+                    nfields += 1
+                jobs = self.dry_run
+            finally:
+                self.dry_run = None
+
+            missing = []
+            pixels = 0
+            for (filename, (paint, args)) in jobs.items():
+                if paint is paint_word:
+                    (width, height) = word_size(self.options, *args)
+                else:
+                    (word, html, font) = args
+                    (width, height) = html_size(self.options, word, font)
+                pixels += width * height
+                if filename not in cached:
+                    missing.append((width * height, paint, args))
+
+            new_pixels = sum(area for (area, paint, args) in missing)
+            (nbytes, seconds) = self.calibrate(missing, new_pixels)
+        finally:
+            self.__dict__.clear()
+            self.__dict__.update(saved)
+
+        estimate = {
+            'fields'     : nfields,
+            'images'     : len(jobs),
+            'cached'     : len(jobs) - len(missing),
+            'pixels'     : pixels,
+            'new_pixels' : new_pixels,
+            'bytes'      : nbytes,
+            'seconds'    : seconds,
+        }
+        if self.debug:
+            self.component_manager.debug(
+                "gogorender: estimate: %(fields)d fields, %(images)d images"
+                " (%(cached)d cached), %(pixels)d pixels (%(new_pixels)d new),"
+                " about %(bytes)d bytes in %(seconds).1f s" % estimate)
+        return estimate
+
+    # Paint a sample of the missing images, a list of (area, paint, args),
+    # and return their estimated (bytes, seconds) by extrapolating the
+    # bytes per pixel and the seconds per image.
+    def calibrate(self, missing, pixels):
+        nsample = max(int(self.setting('estimate_sample')), 1)
+        step = max(len(missing) // nsample, 1)
+        sample = missing[::step]
+        if not sample:
+            return (0, 0.0)
+
+        options = dict(self.options, debug=None, stats=None)
+        tmpdir = tempfile.mkdtemp(prefix="gogorender-")
+        try:
+            start = clock()
+            (area, nbytes) = (0, 0)
+            for (i, (a, paint, args)) in enumerate(sample):
+                path = os.path.join(tmpdir, "%d.png" % i)
+                result = paint(path, options, *args)
+                if result is not None:
+                    area += a
+                    nbytes += os.path.getsize(path)
+            elapsed = clock() - start
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+        return (int(pixels * float(nbytes) / max(area, 1)),
+                len(missing) * elapsed / len(sample))
+
+    # Merge the words (as from segment(), but with a font for each scale)
+    # with the text between them into one, for fewer images. Words are
+    # merged if segment() gives the gap between them, the image is at most
+    # coalesce_width wide, and substitute() will find the merged text where
+    # it finds the first of the words (otherwise it could not replace it,
+    # e.g., if the gap came from '&nbsp;', or would replace a later copy).
+    #
+    # The text is searched as substitute() does, in one forward pass: a
+    # word is looked for from where the previous one was found, within a
+    # stretch of text between tags, and then in the following stretches.
+    def coalesce(self, text, words):
+        stretches = [(start, end) for (start, end) in self.stretches(text)
+                     if end > start and text[start] != '<']
+        merged = []
+        k = 0           # the stretch, and the position in it, from which
+        p = 0           # the next word is looked for
+        found = -1      # position of merged[-1] in the text, or -1
+
+        for (start, end, word, fonts, color, gap) in words:
+            if merged and gap is not None and found >= 0:
+                (start0, end0, word0, fonts0, color0, gap0) = merged[-1]
+                joined = word0 + gap + word
+                if (found + len(joined) <= stretches[k][1]
+                        and text.startswith(joined, found)):
+                    (width, height) = word_size(self.options, joined,
+                                                fonts0[0], False)
+                    if width <= self.coalesce_width:
+                        merged[-1] = (start0, end, joined, fonts0, color0,
+                                      gap0)
+                        p = found + len(joined)
+                        continue
+
+            found = -1
+            while k < len(stretches):
+                found = text.find(word, max(p, stretches[k][0]),
+                                  stretches[k][1])
+                if found >= 0:
+                    p = found + len(word)
+                    break
+                k += 1
+            merged.append((start, end, word, fonts, color, gap))
+        return merged
+
+    # Yields (start, end) for each stretch of text between tags.
+    def stretches(self, text):
+        start = 0
+        for tag in self.tag_re.finditer(text):
+            yield (start, tag.start())
+            start = tag.end()
+        yield (start, len(text))
+
+    # Replace, in order, the first occurrence of each word in mapping, a
+    # list of (word, path) pairs, outside of tags with an image. A word is
+    # looked for from where the previous one was found, within a single
+    # stretch of text between tags; words that cannot be found there are
+    # looked for in the following stretches. The text is scanned and copied
+    # once, whatever the number of words.
     def substitute(self, text, mapping):
         r = []
-        for s in self.tag_re.split(text):
-            if len(s) == 0 or s[0] == '<':
-                r.append(s)
-                continue
+        m = 0           # next entry of mapping
+        copied = 0      # text[:copied] has been added to r
 
-            while mapping:
-                (match, path) = mapping[0]
+        for (start, end) in self.stretches(text):
+            if m == len(mapping):
+                break
+            if end == start or text[start] == '<':
+                continue
 
-                (before, x, after) = s.partition(match)
-                if x == '':
-                    s = before
+            p = start
+            while m < len(mapping):
+                (match, path) = mapping[m]
+                i = text.find(match, p, end)
+                if i < 0:
                     break
-                
-                r.append(before)
+                r.append(text[copied:i])
                 r.append('<img src="%s"/>' % path)
-                mapping = mapping[1:]
-                s = after
-
-            r.append(s)
+                p = copied = i + len(match)
+                m += 1
 
+        r.append(text[copied:])
         return ''.join(r)
 
+    # Images are rendered at font_scaling and at each of the 'extra_scales',
+    # from a single pass over the text, but the text returned refers to
+    # those of one of the scales: the one given by the render argument
+    # gogorender_scale, if any, and otherwise the one chosen by
+    # select_scale(). The texts for the other scales are memoized.
+    #
+    # The memo has an entry for each scale (for lines, only that of the
+    # scale rendered for has a text), and is only used if all of them are
+    # there, so that the images of every scale are marked as used.
     def run(self, text, card, fact_key, **render_args):
+        if (self.detect_exports and self.dry_run is None
+                and not self.prerendering):
+            self.export_activity(card)
+
+        self.counters['fields'] += 1
+        if not self.prefilter(text):
+            self.counters['fields_skipped'] += 1
+            return text
+
+        variants = self.variants
+        for variant in variants:
+            variant.cache.refresh()
+
+        if 'gogorender_scale' in render_args:
+            target = self.variant_index(render_args['gogorender_scale'])
+        else:
+            target = self.target
+
+        stats = self.stats
+        if stats: t = clock()
+
+        proxy_key = card.card_type.fact_key_format_proxies()[fact_key]
+        (font_string, font) = self.card_font(card.card_type, proxy_key)
+        if stats: t = stats.add('font', t)
+
+        render_line = bool(
+            {True for t in card.tags if t.name in self.render_line_tags})
+
+        memo_key = (text, font_string, render_line)
+        memo_entries = [self.memo.get(memo_key + (i,), variant.cache)
+                        for (i, variant) in enumerate(variants)]
+        if None not in memo_entries and memo_entries[target][0] is not None:
+            for (variant, (memo_text, names)) in zip(variants, memo_entries):
+                for name in names:
+                    variant.cache.touch(name)
+            self.counters['fields_memo'] += 1
+            return memo_entries[target][0]
+
         doc = QTextDocument()
         doc.setUndoRedoEnabled(False)
         doc.setDocumentMargin(0.0)
         doc.setIndentWidth(0.0)
         doc.setUseDesignMetrics(True)
-        doc_modified = False
 
-        proxy_key = card.card_type.fact_key_format_proxies()[fact_key]
-        font_string = self.config().card_type_property(
-            "font", card.card_type, proxy_key)
-
-        if font_string:
-            family,size,x,x,weight,italic,u,s,x,x = font_string.split(",")
-            font = QtGui.QFont(family, int(size), int(weight), bool(int(italic)))
+        if font is not None:
             doc.setDefaultFont(font)
 
-        if {True for t in card.tags if t.name in self.render_line_tags}:
-            render_line = True
-            not_word_re = self.not_line_re
-        else:
-            render_line = False
-            not_word_re = self.not_word_re
-
         doc.setHtml(text)
+        if stats: t = stats.add('parse', t)
         if self.debug:
             self.component_manager.debug(
                 "gogorender: %s\ngogorender: %s\ngogorender: %s"
                 % (70 * "-", text, 70 * "-"))
 
-        render = []
-        pos = doc.find(self.render_char_re)
-        while not pos.isNull():
-            s = pos.selectedText()
-            if (self.not_render_char_re.exactMatch(s)
-                    or not_word_re.exactMatch(s)):
-                self.debugline("skip", pos)
-                movenext(pos)
-                pos = doc.find(self.render_char_re, pos)
-                continue;
-            self.debugline("===", pos)
-
-            fmt = pos.charFormat()
-            font = fmt.font()
-            color = fmt.foreground().color()
-
-            # find the start of the word
-            #moveprev(pos)
-            while not pos.atBlockStart():
-                moveprev(pos)
-                s = pos.selectedText()
-                ccolor = pos.charFormat().foreground().color()
-                self.debugline("<--", pos)
-
-                if len(s) > 0 and not_word_re.exactMatch(s[0]):
-                    movenext(pos)
-                    self.debugline("-->", pos)
-                    break;
-
-                if (not render_line and
-                        (pos.charFormat().font() != font or ccolor != color)):
-                    break;
-
-            pos.setPosition(pos.position(), QTextCursor.MoveAnchor)
-
-            # find the end of the word
-            while not pos.atBlockEnd():
-                movenext(pos)
-                s = pos.selectedText()
-                ccolor = pos.charFormat().foreground().color()
-                self.debugline("-->", pos)
-
-                if ((not render_line and
-                           (pos.charFormat().font() != font or ccolor != color))
-                        or not_word_re.exactMatch(s[-1])):
-                    moveprev(pos)
-                    self.debugline("<-)", pos)
-                    break;
-
-            if pos.hasSelection():
-                word = unicode(pos.selectedText())
+        # each word gets its font at every scale
+        words = [(start, end, word,
+                  [self.scaled_font(font, v.font_scaling) for v in variants],
+                  color, gap)
+                 for (start, end, word, font, color, gap)
+                 in self.segment(doc, render_line)]
+        if self.coalesce_words and not render_line:
+            words = self.coalesce(text, words)
+        if stats: t = stats.add('segment', t)
+
+        render = [[] for variant in variants]
+        lines = []
+        line_names = [[] for variant in variants]
+        for (start, end, word, fonts, color, gap) in words:
+            if self.debug:
+                self.component_manager.debug(
+                    u'gogorender: word="%s"' % word)
+
+            if render_line:
+                pos = QTextCursor(doc)
+                pos.setPosition(start)
+                pos.setPosition(end, QTextCursor.KeepAnchor)
+                selection = pos.selection()
+                paths = [variant.render_html(word, selection, font)
+                         for (variant, font) in zip(variants, fonts)]
+                if paths[target] is not None:
+                    lines.append((pos, paths[target]))
+                for (path, names) in zip(paths, line_names):
+                    if path is not None:
+                        names.append(path.rsplit("/", 1)[-1])
+            else:
+                for (variant, font, r) in zip(variants, fonts, render):
+                    path = variant.render_word(word, font, color, render_line)
+                    if path is not None:
+                        r.append((word, unicode(path)))
+
+        if stats: t = clock()
+
+        # the cursors follow the edits, so the positions stay valid
+        for (pos, path) in lines:
+            pos.removeSelectedText()
+            pos.insertImage(path)
+
+        if render_line:
+            if lines:
+                text = body_match_re.sub(r'\g<body>', unicode(doc.toHtml()))
+            for (i, names) in enumerate(line_names):
+                self.memo.put(memo_key + (i,), text if i == target else None,
+                              names)
+        else:
+            source = text
+            for (i, mapping) in enumerate(render):
+                if mapping:
+                    rendered = self.substitute(unicode(source), mapping)
+                else:
+                    rendered = source
+                names = [path.rsplit("/", 1)[-1] for (x, path) in mapping]
+                self.memo.put(memo_key + (i,), rendered, names)
+                if i == target:
+                    text = rendered
+        if stats: stats.add('substitute', t)
 
-                if self.debug:
-                    self.component_manager.debug(
-                        u'gogorender: word="%s"' % word)
+        return text
 
-                font.setPointSizeF((font.pointSize() +
-                                    self.non_latin_font_size_increase)
-                                   * self.setting('font_scaling'))
+class GogorenderPrerender(Hook):
+    """Renders the fields of added and edited cards while the application
+    is idle, so that the next export mostly finds its images in the cache.
 
-                if render_line:
-                    html = unicode(pos.selection().toHtml())
-                    path = self.render_html(word, html, font)
-                else:
-                    path = self.render_word(word, font, color, render_line)
+    The database's add_card and update_card are wrapped after it is
+    loaded (Mnemosyne has no hooks for them). Cards are queued by id: a
+    card edited again before it is rendered is not queued twice, and is
+    rendered as it is then. At most 'prerender_queue_size' cards wait;
+    beyond that, the oldest are left for the export to render.
 
-                if path is not None:
-                    if render_line:
-                        pos.removeSelectedText()
-                        pos.insertImage(path)
-                        doc_modified = True
-                    else:
-                        render.append((word, unicode(path)))
+    The work is done by a zero-interval timer, i.e., whenever the event
+    loop is idle, and only if no events are pending. Each tick does one
+    step: segmenting the fields of a card to find its missing images, or
+    painting one of them.
+    """
+    used_for = "after_load"
 
-            pos = doc.find(self.render_char_re, pos)
+    def __init__(self, component_manager):
+        Hook.__init__(self, component_manager)
+        self.queue = OrderedDict()
+        self.jobs = deque()
+        self.timer = None
+        self.wrapped = None
 
-        if doc_modified:
-            text = body_match_re.sub(r'\g<body>', unicode(doc.toHtml()))
-        elif render:
-            text = self.substitute(unicode(text), render)
+    def setting(self, key):
+        try:
+            config = self.config()["gogorender"]
+        except KeyError: config = {}
+        return config.get(key, default_config[key])
 
-        return text
+    def run(self):
+        self.stop()
+        if not self.setting('prerender'):
+            return
+
+        database = self.database()
+        add_card = database.add_card
+        update_card = database.update_card
+
+        def add_card_and_queue(card):
+            add_card(card)
+            self.push(card)
+
+        def update_card_and_queue(card, repetition_only=False):
+            update_card(card, repetition_only)
+            if not repetition_only:
+                self.push(card)
+
+        database.add_card = add_card_and_queue
+        database.update_card = update_card_and_queue
+        self.wrapped = (database, add_card, update_card)
+
+        self.queue_size = int(self.setting('prerender_queue_size'))
+        self.timer = QtCore.QTimer()
+        self.timer.setInterval(0)
+        self.timer.timeout.connect(self.render_next)
+
+    def stop(self):
+        """Drop the queued cards and restore the database."""
+        if self.timer is not None:
+            self.timer.stop()
+            self.timer = None
+        self.queue.clear()
+        self.jobs.clear()
+
+        if self.wrapped is not None:
+            (database, add_card, update_card) = self.wrapped
+            database.add_card = add_card
+            database.update_card = update_card
+            self.wrapped = None
+
+    def push(self, card):
+        self.queue.pop(card.id, None)
+        self.queue[card.id] = True
+        while len(self.queue) > self.queue_size:
+            self.queue.popitem(last=False)
+        if self.timer is not None and not self.timer.isActive():
+            self.timer.start()
+
+    def render_next(self):
+        if QtCore.QCoreApplication.hasPendingEvents():
+            return
+
+        if self.jobs:
+            (filter, variant, filename, job) = self.jobs.popleft()
+            filter.paint_job(variant, filename, job)
+            return
+
+        if not self.queue:
+            self.timer.stop()
+            return
+
+        (card_id, queued) = self.queue.popitem(last=False)
+        for chain in render_chains:
+            try:
+                render_chain = self.render_chain(chain)
+                filter = render_chain.filter(Gogorender)
+                if not filter:
+                    continue
+                card = self.database().card(card_id, is_id_internal=False)
+
+                def render():
+                    render_chain.render_question(card)
+                    render_chain.render_answer(card)
+
+                self.jobs.extend((filter,) + job
+                                 for job in filter.collect_jobs(render))
+                break
+            except KeyError: pass
+            except Exception as e:  # e.g., the card was deleted
+                if self.component_manager.debug_file != None:
+                    self.component_manager.debug(
+                        "gogorender: not prerendering card %s (%s)"
+                        % (card_id, e))
+                break
+
+class GogorenderPrerenderStop(Hook):
+    """Stops prerendering and saves the state of the filters before the
+    database is unloaded."""
+    used_for = "before_unload"
+
+    def run(self):
+        for hook in self.component_manager.all("hook", "after_load"):
+            if isinstance(hook, GogorenderPrerender):
+                hook.stop()
+
+        for chain in render_chains:
+            try:
+                filter = self.render_chain(chain).filter(Gogorender)
+                if filter:
+                    filter.flush()
+            except KeyError: pass
 
 class GogorenderPlugin(Plugin):
     name = name
     description = (tr("Render words as image files on Mnemogogo export.") +
                    " (v" + version + ")")
-    components = [GogorenderConfig, GogorenderConfigWdgt, Gogorender]
+    components = [GogorenderConfig, GogorenderConfigWdgt, Gogorender,
+                  GogorenderPrerender, GogorenderPrerenderStop]
 
     def __init__(self, component_manager):
         Plugin.__init__(self, component_manager)
@@ -512,17 +2838,33 @@ class GogorenderPlugin(Plugin):
                 self.new_render_chain(chain)
             except KeyError: pass
 
+        # The database may already have been loaded.
+        if self.database().is_loaded():
+            for hook in self.component_manager.all("hook", "after_load"):
+                if isinstance(hook, GogorenderPrerender):
+                    hook.run()
+
     def deactivate(self):
+        for hook in self.component_manager.all("hook", "after_load"):
+            if isinstance(hook, GogorenderPrerender):
+                hook.stop()
         Plugin.deactivate(self)
         for chain in render_chains:
             try:
+                filter = self.render_chain(chain).filter(Gogorender)
+                if filter:
+                    filter.flush()
+                    filter.close_workers()
                 self.render_chain(chain).unregister_filter(Gogorender)
             except KeyError: pass
 
     def new_render_chain(self, name):
         if name in render_chains:
-            self.render_chain(name).register_filter_at_back(
+            render_chain = self.render_chain(name)
+            render_chain.register_filter_at_back(
                     Gogorender, before=["ExpandPaths"])
+            if name == 'mnemogogo':
+                render_chain.filter(Gogorender).detect_exports = True
 
 # Register plugin.
 
@@ -0,0 +1,68 @@
+#!/usr/bin/python
+# encoding: utf-8
+##############################################################################
+#
+# testclassify.py
+#
+# Checks the character class table built by gogorender.class_table against
+# the patterns themselves (gogorender.classify, i.e., QRegExp.exactMatch)
+# for every code point of the BMP, with the default settings and with some
+# other patterns, including ones that the table cannot build in one pass.
+#
+# Only QtCore is used (no application is created), so unlike benchmark.py
+# and testsegment.py this needs no display, and no Xvfb.
+#
+# Requires PyQt4 and Mnemosyne (for the plugin's imports).
+#
+##############################################################################
+
+from __future__ import print_function
+
+import sys
+
+from PyQt4.QtCore import QRegExp
+
+import gogorender
+from gogorender import (RENDER, NOT_RENDER, NOT_WORD, NOT_LINE,
+                        UNCLASSIFIED, class_table, classify)
+
+settings = [
+    (gogorender.default_config['render_char'],
+     gogorender.default_config['not_render_char']),
+    (u'[֐-׿؀-ۿ]', u'[־]'),
+    (u'[^\\x00-\\x7f]', u'[\\s ]'),   # matches nbsp as a space
+    (u'[぀-ヿ]|[一-鿿]', u'[]'),  # not a bracket expression
+    (u'\\w', u'[\\d_]'),
+]
+
+def check(render_char, not_render_char):
+    regexps = ((QRegExp(render_char), RENDER),
+               (QRegExp(not_render_char), NOT_RENDER),
+               (QRegExp(gogorender.not_word), NOT_WORD),
+               (QRegExp(gogorender.not_line), NOT_LINE))
+    table = class_table(regexps)
+
+    errors = 0
+    unclassified = 0
+    for o in range(0x10000):
+        if table[o] == UNCLASSIFIED:
+            unclassified += 1
+            continue
+        expected = classify(unichr(o), regexps)
+        if table[o] != expected:
+            if errors < 10:
+                print("  U+%04X: table %d, patterns %d"
+                      % (o, table[o], expected))
+            errors += 1
+
+    print("%s %s: %d errors, %d unclassified"
+          % (render_char.encode('unicode_escape'),
+             not_render_char.encode('unicode_escape'), errors, unclassified))
+    return errors
+
+def main():
+    errors = sum(check(r, n) for (r, n) in settings)
+    sys.exit(1 if errors else 0)
+
+if __name__ == '__main__':
+    main()
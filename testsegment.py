@@ -0,0 +1,222 @@
+#!/usr/bin/python
+# encoding: utf-8
+##############################################################################
+#
+# testsegment.py
+#
+# Checks that Gogorender.segment gives the same words as the cursor walk
+# that it replaced (including the quirk that the character after a skipped
+# one never starts a word), and that Gogorender.substitute gives the same
+# text as the partition loop that it replaced, over the decks of
+# benchmark.py and some edge cases, in word and in line mode.
+#
+# Qt 4 renders text through the window system, so on X11 a display is
+# needed. Without one (DISPLAY unset), the script runs itself under
+# xvfb-run, as benchmark.py does.
+#
+# Requires PyQt4 and Mnemosyne (for the plugin's imports), and Xvfb on
+# machines without a display.
+#
+##############################################################################
+
+from __future__ import print_function
+
+import argparse
+import shutil
+import sys
+import tempfile
+
+import benchmark    # sets up the display and the application
+
+from PyQt4.QtGui import QTextDocument, QTextCursor
+
+edge_cases = [
+    u'中',
+    u'中—',                         # skipped characters at block ends
+    u'—中',
+    u'—中文',
+    u'中—文',
+    u'中文—<br>—文',
+    u'…中文…',
+    u'—<br>中',
+    u'<b>中</b>文',                  # mixed fonts and colors
+    u'中<i>文字</i>x',
+    u'<font color="red">中</font>文<font color="blue">字</font>',
+    u'<span style="font-size:20pt">中</span>文',
+    u'中&nbsp;文',                  # spaces and entities
+    u'a&nbsp;b 中&nbsp;&nbsp;文',
+    u'中 文\xa0字',
+    u'&lt;中&gt; &amp;文 &#x4e2d;&#20013;',
+    u'\U00020000中 \U0001d11e',      # outside the BMP
+    u'中\U00020000<b>\U00020001</b>文',
+    u'中 中 文中',                   # repeated words
+    u'<b>中</b>中 中',
+    u'中<b>文</b> 中文 文',           # words found in a later stretch
+    u'<a title="中">文</a>中',
+    u'中文<br>中<br>文中',
+    u'<p>中文</p><p>字</p>',
+    u'<ul><li>中</li><li>文 字</li></ul>',
+    u'中<img src="x.png">文',
+    u'',
+    u'plain latin text only',
+]
+
+def moveprev(pos):
+    pos.movePosition(QTextCursor.PreviousCharacter, QTextCursor.KeepAnchor)
+
+def movenext(pos):
+    pos.movePosition(QTextCursor.NextCharacter, QTextCursor.KeepAnchor)
+
+# The cursor walk of the original Gogorender.run, without the rendering.
+# Returns a list of (start, end, word, font, color).
+def old_segment(filter, doc, render_line):
+    not_word_re = filter.not_line_re if render_line else filter.not_word_re
+    words = []
+
+    pos = doc.find(filter.render_char_re)
+    while not pos.isNull():
+        s = pos.selectedText()
+        if (filter.not_render_char_re.exactMatch(s)
+                or not_word_re.exactMatch(s)):
+            movenext(pos)
+            pos = doc.find(filter.render_char_re, pos)
+            continue
+
+        fmt = pos.charFormat()
+        font = fmt.font()
+        color = fmt.foreground().color()
+
+        while not pos.atBlockStart():
+            moveprev(pos)
+            s = pos.selectedText()
+            ccolor = pos.charFormat().foreground().color()
+            if len(s) > 0 and not_word_re.exactMatch(s[0]):
+                movenext(pos)
+                break
+            if (not render_line and
+                    (pos.charFormat().font() != font or ccolor != color)):
+                break
+
+        pos.setPosition(pos.position(), QTextCursor.MoveAnchor)
+
+        while not pos.atBlockEnd():
+            movenext(pos)
+            s = pos.selectedText()
+            ccolor = pos.charFormat().foreground().color()
+            if ((not render_line and
+                       (pos.charFormat().font() != font or ccolor != color))
+                    or not_word_re.exactMatch(s[-1])):
+                moveprev(pos)
+                break
+
+        if pos.hasSelection():
+            words.append((pos.selectionStart(), pos.selectionEnd(),
+                          unicode(pos.selectedText()), font, color))
+
+        pos = doc.find(filter.render_char_re, pos)
+
+    return words
+
+def new_segment(filter, doc, render_line):
+    return [(start, end, word, font, color)
+            for (start, end, word, font, color, gap)
+            in filter.segment(doc, render_line)]
+
+# The original Gogorender.substitute.
+def old_substitute(tag_re, text, mapping):
+    r = []
+    for s in tag_re.split(text):
+        if len(s) == 0 or s[0] == '<':
+            r.append(s)
+            continue
+
+        while mapping:
+            (match, path) = mapping[0]
+
+            (before, x, after) = s.partition(match)
+            if x == '':
+                s = before
+                break
+
+            r.append(before)
+            r.append('<img src="%s"/>' % path)
+            mapping = mapping[1:]
+            s = after
+
+        r.append(s)
+
+    return ''.join(r)
+
+def make_doc(text, font):
+    doc = QTextDocument()
+    doc.setUndoRedoEnabled(False)
+    doc.setDocumentMargin(0.0)
+    doc.setIndentWidth(0.0)
+    doc.setUseDesignMetrics(True)
+    if font is not None:
+        doc.setDefaultFont(font)
+    doc.setHtml(text)
+    return doc
+
+def describe(words):
+    return [(start, end, word.encode('unicode_escape'),
+             unicode(font.toString()), unicode(color.name()))
+            for (start, end, word, font, color) in words]
+
+def check(filter, text, card, fact_key):
+    proxy_key = card.card_type.fact_key_format_proxies()[fact_key]
+    (font_string, font) = filter.card_font(card.card_type, proxy_key)
+
+    errors = 0
+    for render_line in (False, True):
+        old = old_segment(filter, make_doc(text, font), render_line)
+        new = new_segment(filter, make_doc(text, font), render_line)
+        if describe(old) != describe(new):
+            print("segment (%s): %s" % ("line" if render_line else "word",
+                                        text.encode('unicode_escape')))
+            print("  old: %s" % describe(old))
+            print("  new: %s" % describe(new))
+            errors += 1
+
+        if not render_line:
+            mapping = [(word, u'%d.png' % i)
+                       for (i, (start, end, word, font, color))
+                       in enumerate(new)]
+            old = old_substitute(filter.tag_re, text, mapping)
+            new = filter.substitute(text, mapping)
+            if old != new:
+                print("substitute: %s" % text.encode('unicode_escape'))
+                print("  old: %s" % old.encode('unicode_escape'))
+                print("  new: %s" % new.encode('unicode_escape'))
+                errors += 1
+    return errors
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare segment and substitute with the originals.")
+    parser.add_argument('--cards', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=1)
+    options = parser.parse_args()
+
+    fields = []
+    for deck in sorted(benchmark.decks):
+        fields.extend(benchmark.make_fields(deck, options.cards, options.seed))
+    (text, card, fact_key) = fields[0]
+    fields.extend((edge, card, fact_key) for edge in edge_cases)
+
+    media_dir = tempfile.mkdtemp(prefix='gogorender-')
+    try:
+        filter = benchmark.make_filter(media_dir, argparse.Namespace(
+            threads=1, processes=0, png_mode='argb', tile_blocks=u'',
+            autocrop=False, dedupe=False, extra_scales=u'',
+            font=u'DejaVu Sans,16,-1,5,50,0,0,0,0,0'))
+        errors = sum(check(filter, text, card, fact_key)
+                     for (text, card, fact_key) in fields)
+    finally:
+        shutil.rmtree(media_dir)
+
+    print("%d fields: %d errors" % (len(fields), errors))
+    sys.exit(1 if errors else 0)
+
+if __name__ == '__main__':
+    main()